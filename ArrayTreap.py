@@ -0,0 +1,845 @@
+# Copyright (C) 2020  Johannes Wolf
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from array import array
+from itertools import zip_longest
+
+from Node import generate_priority, can_fingerprint, node_fingerprint, segment_ids
+from Treap import Treap, analyze_levels
+from Interval import n_inf, p_inf
+
+## index of a missing child
+NIL = -1
+## bytes per node of the six arrays and the five lists of ArrayTreap
+NODE_BYTES = 8 * 11
+
+
+class ArrayTreap:
+    """A class for treaps as the base data structure for segment treaps
+    using zipping, stored in parallel arrays instead of Node objects.
+
+    Node i has the key key[i], the priority priority[i], the children
+    left[i] and right[i] (NIL if missing), the associated interval
+    [interval_left[i], interval_right[i]], the canonical subset can[i] (None
+    while empty) and the belonging segment belonging_segment[i].
+    fingerprints[i], max_covers[i] and weights[i] cache the fingerprint, the
+    maximum cover and the weights of its subtree (None while stale, see
+    Treap.fingerprint, Treap.max_overlap and Treap.update_weights).
+    Indices of deleted nodes are kept in a free list and reused.
+    """
+    ## counters of the updates while recording, None otherwise
+    stats = None
+
+    ## FlatTreap copy of self, see Treap.flattened
+    flat = None
+
+    recording = Treap.recording
+    flattened = Treap.flattened
+
+    def __init__(self):
+        """Return a treap that only consists of the dummy leaf."""
+        self.key = array('d')
+        self.priority = array('d')
+        self.left = array('q')
+        self.right = array('q')
+        self.interval_left = array('d')
+        self.interval_right = array('d')
+        self.can = []
+        self.belonging_segment = []
+        self.fingerprints = []
+        self.max_covers = []
+        self.weights = []
+        self.stale_keys = None
+        self.flat = None
+        self.free = []
+        self.root = self.new_node(n_inf, n_inf, n_inf, p_inf)
+
+    def __eq__(self, other):
+        """Return True iff self and other have the same structure, keys,
+        priorities, associated intervals and canonical subsets. other may 
+        also be a Treap, see Treap.__eq__."""
+        if self.fingerprint() != other.fingerprint():
+            return False
+        return all(record == other_record for record, other_record in zip_longest(self.preorder(), other.preorder()))
+
+    def preorder(self):
+        """Yield a record of each node in preorder, see Treap.preorder."""
+        keys, left, right, can = self.key, self.left, self.right, self.can
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            yield (keys[node], self.priority[node], self.interval_left[node], self.interval_right[node],
+                segment_ids(can[node]), left[node] != NIL, right[node] != NIL)
+            if right[node] != NIL:
+                stack.append(right[node])
+            if left[node] != NIL:
+                stack.append(left[node])
+
+    def fingerprint(self):
+        """Return a Merkle-style hash of self. It equals the fingerprint of
+        a Treap with the same content, see Treap.fingerprint."""
+        if self.stale_keys:
+            self.mark_stale()
+        self.stale_keys = set()
+        fingerprints, left, right = self.fingerprints, self.left, self.right
+        stack = [(self.root, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if not children_done:
+                stack.append((node, True))
+                for child in (left[node], right[node]):
+                    if child != NIL and fingerprints[child] is None:
+                        stack.append((child, False))
+                continue
+            fingerprints[node] = node_fingerprint(self.key[node], self.priority[node],
+                self.interval_left[node], self.interval_right[node], can_fingerprint(self.can[node]),
+                0 if left[node] == NIL else fingerprints[left[node]],
+                0 if right[node] == NIL else fingerprints[right[node]])
+        return fingerprints[self.root]
+
+    def max_overlap(self):
+        """Return the maximum number of segments that contain a common point
+        and the smallest such point, see Treap.max_overlap."""
+        if self.stale_keys:
+            self.mark_stale()
+        self.stale_keys = set()
+        max_covers, left, right, can = self.max_covers, self.left, self.right, self.can
+        stack = [(self.root, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if not children_done:
+                stack.append((node, True))
+                for child in (left[node], right[node]):
+                    if child != NIL and max_covers[child] is None:
+                        stack.append((child, False))
+                continue
+            size = 0 if can[node] is None else len(can[node])
+            if left[node] == NIL:
+                if self.interval_left[node] < self.interval_right[node]:
+                    max_covers[node] = (size, self.interval_left[node])
+                else:
+                    max_covers[node] = (n_inf, self.interval_left[node])
+            else:
+                low, high = max_covers[left[node]], max_covers[right[node]]
+                depth, point = low if low[0] >= high[0] else high
+                max_covers[node] = (depth + size, point)
+        return max_covers[self.root]
+
+    def update_weights(self):
+        """Bring the cached weights of all nodes up to date, see 
+        Treap.update_weights."""
+        if self.stale_keys:
+            self.mark_stale()
+        self.stale_keys = set()
+        weights, left, right, can = self.weights, self.left, self.right, self.can
+        stack = [(self.root, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if not children_done:
+                stack.append((node, True))
+                for child in (left[node], right[node]):
+                    if child != NIL and weights[child] is None:
+                        stack.append((child, False))
+                continue
+            weight = 0 if can[node] is None else sum(segment.weight for segment in can[node])
+            if left[node] == NIL:
+                if self.interval_left[node] < self.interval_right[node]:
+                    weights[node] = (weight, weight, self.interval_left[node])
+                else:
+                    weights[node] = (weight, n_inf, self.interval_left[node])
+            else:
+                low, high = weights[left[node]], weights[right[node]]
+                _, best, point = low if low[1] >= high[1] else high
+                weights[node] = (weight, weight + best, point)
+
+    def weight_at(self, point):
+        """Return the total weight of the segments that contain point, see
+        Treap.weight_at."""
+        self.update_weights()
+        keys, left, right, weights = self.key, self.left, self.right, self.weights
+        weight = 0
+        node = self.root
+        while node != NIL:
+            weight += weights[node][0]
+            node = left[node] if point < keys[node] else right[node]
+        return weight
+
+    def max_weight_in(self, interval):
+        """Return the maximum total weight of the segments that contain a
+        common point of interval and the smallest such point, see 
+        Treap.max_weight_in."""
+        self.update_weights()
+        low, high = interval.left, interval.right
+        interval_left, interval_right = self.interval_left, self.interval_right
+        best, best_point = n_inf, None
+        stack = [(self.root, 0)]
+        while stack:
+            node, above = stack.pop()
+            node_low, node_high = interval_left[node], interval_right[node]
+            if node_low >= node_high:
+                continue
+            if low < high:
+                if node_high <= low or node_low >= high:
+                    continue
+            elif not node_low <= low < node_high:
+                continue
+            weight, subtree, point = self.weights[node]
+            if low < high and low <= node_low and node_high <= high:
+                candidate = above + subtree
+            elif self.left[node] == NIL:
+                candidate, point = above + weight, max(low, node_low)
+            else:
+                stack.append((self.right[node], above + weight))
+                stack.append((self.left[node], above + weight))
+                continue
+            if candidate > best or (candidate == best and point < best_point):
+                best, best_point = candidate, point
+        return best, best_point
+
+    def invalidate_around(self, key):
+        """Report that self changed around key, see Treap.invalidate_around."""
+        self.flat = None
+        if self.stale_keys is not None:
+            self.stale_keys.add(key)
+            if len(self.stale_keys) > Treap.max_stale_keys:
+                self.mark_stale()
+
+    def mark_stale(self):
+        """Mark the fingerprints, maximum covers and weights of all nodes 
+        whose associated interval contains one of the stale keys and of 
+        their children as stale, see Treap.mark_stale."""
+        fingerprints, max_covers, weights = self.fingerprints, self.max_covers, self.weights
+        for key in self.stale_keys:
+            stack = [self.root]
+            while stack:
+                node = stack.pop()
+                fingerprints[node] = max_covers[node] = weights[node] = None
+                for child in (self.left[node], self.right[node]):
+                    if child == NIL:
+                        continue
+                    if self.interval_left[child] <= key <= self.interval_right[child]:
+                        stack.append(child)
+                    else:
+                        fingerprints[child] = max_covers[child] = weights[child] = None
+        self.stale_keys.clear()
+
+    def shape_stats(self):
+        """Return a dict of the number of nodes, the depth, and the total and
+        the largest size of the canonical subsets of self, see 
+        Treap.shape_stats."""
+        shape = {"nodes": 0, "depth": 0, "can_entries": 0, "max_can": 0}
+        stack = [(self.root, 1)]
+        while stack:
+            node, depth = stack.pop()
+            size = 0 if self.can[node] is None else len(self.can[node])
+            shape["nodes"] += 1
+            shape["depth"] = max(shape["depth"], depth)
+            shape["can_entries"] += size
+            shape["max_can"] = max(shape["max_can"], size)
+            for child in (self.left[node], self.right[node]):
+                if child != NIL:
+                    stack.append((child, depth + 1))
+        return shape
+
+    def analyze(self):
+        """Return a report on the shape of self and the memory of its 
+        canonical subsets, see Treap.analyze. A node takes NODE_BYTES."""
+        def nodes():
+            stack = [(self.root, 0)]
+            while stack:
+                node, depth = stack.pop()
+                yield depth, self.can[node], NODE_BYTES, self.is_leaf(node)
+                for child in (self.right[node], self.left[node]):
+                    if child != NIL:
+                        stack.append((child, depth + 1))
+        return analyze_levels(nodes())
+
+    def count_spine(self, node, key):
+        """Count an insert that zips along the search path for key below 
+        node, see Treap.recording."""
+        length = 0
+        while node != NIL:
+            length += 1
+            node = self.left[node] if key < self.key[node] else self.right[node]
+        self.stats["inserts"] += 1
+        self.stats["spine_nodes"] += length
+        self.stats["max_spine"] = max(self.stats["max_spine"], length)
+
+    def __len__(self):
+        """Return the number of nodes in self."""
+        return len(self.key) - len(self.free)
+
+    def is_empty(self):
+        """Return True iff the treap is empty. It always holds the dummy leaf."""
+        return self.root == NIL
+
+    def is_leaf(self, node):
+        """Return True iff node is a leaf."""
+        return self.left[node] == NIL and self.right[node] == NIL
+
+    def new_node(self, key, priority, low, high, belonging_segment = None):
+        """Return the index of a new node without children."""
+        if self.free:
+            node = self.free.pop()
+            self.key[node] = key
+            self.priority[node] = priority
+            self.left[node] = NIL
+            self.right[node] = NIL
+            self.interval_left[node] = low
+            self.interval_right[node] = high
+            self.can[node] = None
+            self.belonging_segment[node] = belonging_segment
+            self.fingerprints[node] = None
+            self.max_covers[node] = None
+            self.weights[node] = None
+            return node
+        self.key.append(key)
+        self.priority.append(priority)
+        self.left.append(NIL)
+        self.right.append(NIL)
+        self.interval_left.append(low)
+        self.interval_right.append(high)
+        self.can.append(None)
+        self.belonging_segment.append(belonging_segment)
+        self.fingerprints.append(None)
+        self.max_covers.append(None)
+        self.weights.append(None)
+        return len(self.key) - 1
+
+    def free_node(self, node):
+        """Put the index of a node that is no longer in the treap on the
+        free list."""
+        self.can[node] = None
+        self.belonging_segment[node] = None
+        self.free.append(node)
+
+    def is_covered_by(self, node, segment):
+        """Return True iff segment covers the associated interval of node."""
+        return segment.left <= self.interval_left[node] and self.interval_right[node] <= segment.right
+
+    def intersects(self, node, segment):
+        """Return True iff segment intersects the associated interval of node."""
+        return self.interval_right[node] > segment.left and self.interval_left[node] < segment.right
+
+    def add_segment_to_cans(self, segment):
+        """Add segment to the appropriate canonical subsets."""
+        left, right = segment.left, segment.right
+        keys, lefts, rights, can = self.key, self.left, self.right, self.can
+        interval_left, interval_right = self.interval_left, self.interval_right
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            low, high = interval_left[node], interval_right[node]
+            if left <= low and high <= right:
+                ## see Node.add_to_can for empty intervals
+                if low == high:
+                    pass
+                elif can[node] is None:
+                    can[node] = {segment}
+                else:
+                    can[node].add(segment)
+                continue
+            split = keys[node]
+            if left < split and lefts[node] != NIL:
+                stack.append(lefts[node])
+            if right > split and rights[node] != NIL:
+                stack.append(rights[node])
+        self.invalidate_around(left)
+        self.invalidate_around(right)
+
+    def add_segments_to_cans(self, segments):
+        """Add all segments to the appropriate canonical subsets in one
+        top-down sweep."""
+        segments = list(segments)
+        self.add_segments_to_subtree_cans(self.root, segments)
+        for segment in segments:
+            self.invalidate_around(segment.left)
+            self.invalidate_around(segment.right)
+
+    def add_segments_to_subtree_cans(self, node, segments, pending = None):
+        """Add all segments to the appropriate canonical subsets in the 
+        subtree of node in one top-down sweep. If pending is given, only
+        descend from nodes in pending. See Node.add_segments_to_cans."""
+        keys, lefts, rights, can = self.key, self.left, self.right, self.can
+        interval_left, interval_right = self.interval_left, self.interval_right
+        stack = [(node, list(segments))]
+        while stack:
+            node, segments = stack.pop()
+            low = interval_left[node]
+            high = interval_right[node]
+            if pending is not None and node not in pending:
+                covering = [segment for segment in segments if segment.left <= low and high <= segment.right]
+                left_segments = right_segments = None
+            else:
+                split = keys[node]
+                covering = []
+                left_segments = []
+                right_segments = []
+                for segment in segments:
+                    if segment.left <= low and high <= segment.right:
+                        covering.append(segment)
+                    else:
+                        if segment.left < split:
+                            left_segments.append(segment)
+                        if segment.right > split:
+                            right_segments.append(segment)
+            ## see Node.add_to_can for empty intervals
+            if covering and low < high:
+                if can[node] is None:
+                    can[node] = set(covering)
+                else:
+                    can[node].update(covering)
+            if left_segments and lefts[node] != NIL:
+                stack.append((lefts[node], left_segments))
+            if right_segments and rights[node] != NIL:
+                stack.append((rights[node], right_segments))
+
+    def remove_segment_from_cans(self, segment):
+        """Remove segment from all canonical subsets."""
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if self.is_covered_by(node, segment):
+                if self.can[node] is not None:
+                    self.can[node].discard(segment)
+                    if not self.can[node]:
+                        self.can[node] = None
+                continue
+            for child in (self.left[node], self.right[node]):
+                if child != NIL and self.intersects(child, segment):
+                    stack.append(child)
+        self.invalidate_around(segment.left)
+        self.invalidate_around(segment.right)
+
+    def add_segment_to_spine_cans(self, node, segment, key):
+        """Add segment to appropriate canonical subsets in the subtree of
+        node, only descending into nodes whose associated interval starts or
+        ends at key. See Node.add_segment_to_spine_cans."""
+        left, right = segment.left, segment.right
+        lefts, rights, can = self.left, self.right, self.can
+        interval_left, interval_right = self.interval_left, self.interval_right
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            low, high = interval_left[node], interval_right[node]
+            if high <= left or low >= right:
+                continue
+            if left <= low and high <= right:
+                if low == high:
+                    pass
+                elif can[node] is None:
+                    can[node] = {segment}
+                else:
+                    can[node].add(segment)
+            elif (low == key or high == key) and lefts[node] != NIL:
+                stack.append(lefts[node])
+                stack.append(rights[node])
+
+    def segments_around_path(self, node, key):
+        """Return the union of the canonical subsets of all nodes on the
+        search path for key starting at node and of their children. See
+        Treap.segments_around_path."""
+        segments = set()
+        can, left, right = self.can, self.left, self.right
+        while node != NIL:
+            if can[node] is not None:
+                segments |= can[node]
+            if key < self.key[node]:
+                other, node = right[node], left[node]
+            else:
+                other, node = left[node], right[node]
+            if other != NIL and can[other] is not None:
+                segments |= can[other]
+        return segments
+
+    def insert_inner_and_leaf(self, key, priority = None, belonging_segment = None):
+        """Insert a segment's endpoint to self using classic zipping, once as
+        an inner node and once as a leaf. See Treap.insert_inner_and_leaf.
+        """
+        if priority is None:
+            priority = generate_priority()
+        keys, left, right, can = self.key, self.left, self.right, self.can
+        curr = self.root
+        parent = NIL
+        while curr != NIL and self.priority[curr] > priority:
+            parent = curr
+            curr = left[curr] if key < keys[curr] else right[curr]
+        segments = self.segments_around_path(curr, key)
+        if self.stats is not None:
+            self.count_spine(curr, key)
+            self.stats["can_scans"] += len(segments)
+        x = self.new_node(key, priority, self.interval_left[curr], self.interval_right[curr], belonging_segment)
+        x_leaf = self.new_node(key, n_inf, key, p_inf, belonging_segment)
+        if parent == NIL:
+            self.root = x
+        elif key < keys[parent]:
+            left[parent] = x
+        else:
+            right[parent] = x
+        can[x], can[curr] = can[curr], None
+        ## Unzip the subtree of curr into the red spine (keys up to key),
+        ## which hangs left of x, and the green spine, which hangs right of x.
+        red, red_is_left = x, True
+        green, green_is_left = x, False
+        while curr != NIL:
+            if keys[curr] <= key:
+                if red_is_left:
+                    left[red] = curr
+                else:
+                    right[red] = curr
+                self.interval_right[curr] = key
+                can[curr] = None
+                if left[curr] != NIL:
+                    can[left[curr]] = None
+                red, red_is_left = curr, False
+                curr = right[curr]
+            else:
+                if green_is_left:
+                    left[green] = curr
+                else:
+                    right[green] = curr
+                self.interval_left[curr] = key
+                can[curr] = None
+                if right[curr] != NIL:
+                    can[right[curr]] = None
+                green, green_is_left = curr, True
+                curr = left[curr]
+        if green_is_left:
+            left[green] = x_leaf
+            self.interval_right[x_leaf] = keys[green]
+        else:
+            right[green] = x_leaf
+            self.interval_right[x_leaf] = self.interval_right[green]
+        for segment in segments:
+            if not self.is_covered_by(x, segment):
+                self.add_segment_to_spine_cans(left[x], segment, key)
+                self.add_segment_to_spine_cans(right[x], segment, key)
+        self.invalidate_around(key)
+
+    def find_inner(self, key, belonging_segment = None):
+        """Return the inner node with the given key and its parent, see
+        Treap.find_inner. Return NIL, NIL if there is no such node."""
+        stack = [(self.root, NIL)]
+        while stack:
+            curr, parent = stack.pop()
+            if curr == NIL or self.is_leaf(curr):
+                continue
+            if self.key[curr] == key and (belonging_segment is None or self.belonging_segment[curr] is belonging_segment):
+                return curr, parent
+            if key <= self.key[curr]:
+                stack.append((self.left[curr], curr))
+            if key >= self.key[curr]:
+                stack.append((self.right[curr], curr))
+        return NIL, NIL
+
+    def delete_inner_and_leaf(self, key, belonging_segment = None):
+        """Delete a segment's endpoint from self by zipping the two subtrees
+        of its inner node back together. See Treap.delete_inner_and_leaf.
+        """
+        x, parent = self.find_inner(key, belonging_segment)
+        if x == NIL:
+            raise KeyError(key)
+        left, right, can = self.left, self.right, self.can
+        red = []
+        curr = left[x]
+        while curr != NIL:
+            red.append(curr)
+            curr = right[curr]
+        green = []
+        curr = right[x]
+        while curr != NIL:
+            green.append(curr)
+            curr = left[curr]
+        x_leaf = green.pop()
+        segments = set()
+        for node in [x, x_leaf] + red + green + [left[node] for node in red] + [right[node] for node in green]:
+            if node != NIL and can[node] is not None:
+                segments |= can[node]
+        spine = []
+        i = j = 0
+        while i < len(red):
+            if j < len(green) and self.priority[green[j]] > self.priority[red[i]]:
+                spine.append(green[j])
+                j += 1
+            else:
+                spine.append(red[i])
+                i += 1
+        top = spine[0]
+        if parent == NIL:
+            self.root = top
+        elif left[parent] == x:
+            left[parent] = top
+        else:
+            right[parent] = top
+        is_red = set(red)
+        for upper, lower in zip(spine, spine[1:]):
+            if upper in is_red:
+                right[upper] = lower
+            else:
+                left[upper] = lower
+        self.interval_right[spine[-1]] = self.interval_right[x_leaf]
+        for node in reversed(spine[:-1]):
+            if node in is_red:
+                self.interval_right[node] = self.interval_right[right[node]]
+            else:
+                self.interval_left[node] = self.interval_left[left[node]]
+        ## Recompute the canonical subsets of the spine and its off-spine
+        ## children. top takes over x's interval, parent and canonical subset.
+        affected = [(top, parent)]
+        for upper, lower in zip(spine, spine[1:]):
+            affected.append((lower, upper))
+        for node in spine[:-1]:
+            affected.append((left[node] if node in is_red else right[node], node))
+        can[top] = can[x]
+        for node, upper in affected[1:]:
+            low, high = self.interval_left[node], self.interval_right[node]
+            upper_low, upper_high = self.interval_left[upper], self.interval_right[upper]
+            can[node] = {segment for segment in segments
+                if low < high and segment.left <= low and high <= segment.right and
+                not (segment.left <= upper_low and upper_high <= segment.right)} or None
+        if self.stats is not None:
+            self.stats["deletes"] += 1
+            self.stats["can_scans"] += (len(affected) - 1) * len(segments)
+        self.free_node(x)
+        self.free_node(x_leaf)
+        self.invalidate_around(key)
+
+    def endpoint_nodes(self, endpoints):
+        """Return the inner nodes and leaves for endpoints in symmetric order,
+        see Treap.endpoint_nodes."""
+        nodes = []
+        for key, priority, belonging_segment in endpoints:
+            nodes.append(self.new_node(key, priority, n_inf, p_inf, belonging_segment))
+            nodes.append(self.new_node(key, n_inf, n_inf, p_inf, belonging_segment))
+        return nodes
+
+    def cartesian_tree(self, nodes):
+        """Link nodes, given in symmetric order, into a treap and return its
+        root, like cartesian_tree in Treap.py."""
+        stack = []
+        for node in nodes:
+            last = NIL
+            while stack and self.priority[stack[-1]] < self.priority[node]:
+                last = stack.pop()
+            self.left[node] = last
+            if stack:
+                self.right[stack[-1]] = node
+            stack.append(node)
+        return stack[0]
+
+    def build(self, endpoints):
+        """Replace the content of self by a treap that contains all given
+        endpoints, each once as an inner node and once as a leaf. See
+        Treap.build."""
+        self.__init__()
+        self.root = self.cartesian_tree([self.root] + self.endpoint_nodes(endpoints))
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if self.left[node] != NIL:
+                child = self.left[node]
+                self.interval_left[child], self.interval_right[child] = self.interval_left[node], self.key[node]
+                stack.append(child)
+            if self.right[node] != NIL:
+                child = self.right[node]
+                self.interval_left[child], self.interval_right[child] = self.key[node], self.interval_right[node]
+                stack.append(child)
+
+    def merge(self, endpoints):
+        """Insert a batch of endpoints into self in one structural pass, each
+        once as an inner node and once as a leaf. See Treap.merge."""
+        if not endpoints:
+            return
+        keys, priorities, lefts, rights, can = self.key, self.priority, self.left, self.right, self.can
+        interval_left, interval_right = self.interval_left, self.interval_right
+        new_nodes = self.endpoint_nodes(endpoints)
+        new = set(new_nodes)
+        ## the nodes whose associated interval changed, and new nodes
+        changed = set(new)
+        ## the nodes whose subtree may have changed, with their parents
+        visited = []
+        ## the nodes whose children were visited as well
+        descended = set()
+        ## the top of each changed region with the segments taken out of it
+        displaced = {}
+        ## whether a key of the batch is already in self or in the batch twice
+        ties = any(endpoints[i][0] == endpoints[i + 1][0] for i in range(len(endpoints) - 1))
+
+        def split(node, pivot):
+            ## The nodes that precede pivot are chained by their right 
+            ## children, the others by their left children. New nodes go 
+            ## right of old ones with the same key.
+            nonlocal ties
+            pivot_key = keys[pivot]
+            pivot_is_new = pivot in new
+            left = right = left_last = right_last = NIL
+            while node != NIL:
+                key = keys[node]
+                if key == pivot_key:
+                    ties = True
+                if key < pivot_key or (key == pivot_key and pivot_is_new):
+                    if left_last == NIL:
+                        left = node
+                    else:
+                        rights[left_last] = node
+                    left_last, node = node, rights[node]
+                else:
+                    if right_last == NIL:
+                        right = node
+                    else:
+                        lefts[right_last] = node
+                    right_last, node = node, lefts[node]
+            if left_last != NIL:
+                rights[left_last] = NIL
+            if right_last != NIL:
+                lefts[right_last] = NIL
+            return left, right
+
+        stack = [(self.root, self.cartesian_tree(new_nodes), NIL, False, n_inf, p_inf, NIL)]
+        while stack:
+            first, second, parent, is_left, low, high, region = stack.pop()
+            if first == NIL or second == NIL:
+                node = second if first == NIL else first
+                left = right = NIL
+            else:
+                if priorities[first] < priorities[second]:
+                    first, second = second, first
+                node = first
+                left, right = split(second, node)
+            if parent == NIL:
+                self.root = node
+            elif is_left:
+                lefts[parent] = node
+            else:
+                rights[parent] = node
+            if node == NIL:
+                continue
+            visited.append((node, parent))
+            if node in new or interval_left[node] != low or interval_right[node] != high:
+                interval_left[node], interval_right[node] = low, high
+                changed.add(node)
+                if region == NIL:
+                    region = node
+                    displaced[region] = []
+                if can[node] is not None:
+                    displaced[region].extend(can[node])
+                    can[node] = None
+            elif left == NIL and right == NIL:
+                continue
+            else:
+                region = NIL
+            descended.add(node)
+            stack.append((rights[node], right, node, False, keys[node], high, region))
+            stack.append((lefts[node], left, node, True, low, keys[node], region))
+        self.flat = None
+        ## Distribute the segments of changed nodes within their changed
+        ## region again and move segments up, see Treap.merge.
+        pending = changed
+        if ties:
+            displaced = {self.root: [segment for segments in displaced.values() for segment in segments]}
+            pending = descended
+        for region, segments in displaced.items():
+            if segments:
+                self.add_segments_to_subtree_cans(region, set(segments), pending)
+        moved = {}
+        for node, parent in reversed(visited):
+            if can[node] is None or parent == NIL:
+                continue
+            if node not in changed and parent in changed:
+                segments = can[node]
+            else:
+                segments = moved.get(node)
+                if not segments:
+                    continue
+            low, high = interval_left[parent], interval_right[parent]
+            moving = [segment for segment in segments if segment.left <= low and high <= segment.right]
+            if moving:
+                can[node] = can[node].difference(moving) or None
+                if low < high:
+                    if can[parent] is None:
+                        can[parent] = set(moving)
+                    else:
+                        can[parent].update(moving)
+                moved.setdefault(parent, []).extend(moving)
+        if self.stale_keys is not None:
+            for node, _ in visited:
+                self.fingerprints[node] = self.max_covers[node] = self.weights[node] = None
+
+    def stab(self, point):
+        """Return the set of all segments that contain point."""
+        return set(self.iter_stab(point))
+
+    def iter_stab(self, point):
+        """Yield all segments that contain point, one at a time. See
+        Treap.iter_stab."""
+        keys, left, right, can = self.key, self.left, self.right, self.can
+        node = self.root
+        while node != NIL:
+            if can[node] is not None:
+                yield from can[node]
+            node = left[node] if point < keys[node] else right[node]
+
+    def count(self, point):
+        """Return the number of segments that contain point. See 
+        Treap.count."""
+        keys, left, right, can = self.key, self.left, self.right, self.can
+        count = 0
+        node = self.root
+        while node != NIL:
+            if can[node] is not None:
+                count += len(can[node])
+            node = left[node] if point < keys[node] else right[node]
+        return count
+
+    def stab_many(self, points):
+        """Return the ids of the segments that contain each of points in
+        CSR form, see FlatTreap.stab_many."""
+        return self.flattened().stab_many(points)
+
+    def count_many(self, points):
+        """Return an array of the number of segments that contain each of
+        points, see FlatTreap.count_many."""
+        return self.flattened().count_many(points)
+
+    def flatten(self):
+        """Return a FlatTreap copy of self. Node indices are kept."""
+        from FlatTreap import FlatTreap
+        return FlatTreap(self.root, self.key, self.left, self.right, self.can)
+
+    def query_overlap(self, interval):
+        """Return the set of all segments that intersect interval."""
+        return set(self.iter_overlap(interval))
+
+    def iter_overlap(self, interval):
+        """Yield all segments that intersect interval, one at a time. Empty
+        segments are never yielded, see Treap.iter_overlap."""
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            low, high = self.interval_left[node], self.interval_right[node]
+            if self.can[node] is not None:
+                for segment in self.can[node]:
+                    first = max(segment.left, interval.left)
+                    if low <= first < high and segment.intersects(interval):
+                        yield segment
+            for child in (self.right[node], self.left[node]):
+                if child == NIL:
+                    continue
+                if self.intersects(child, interval) or \
+                self.interval_left[child] <= interval.left < self.interval_right[child]:
+                    stack.append(child)
+
+    def display(self):
+        return
@@ -0,0 +1,96 @@
+# Copyright (C) 2020  Johannes Wolf
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+
+## index of a missing child
+NIL = -1
+
+
+class FlatTreap:
+    """A read-only copy of a segment treap in NumPy arrays for vectorized
+    queries, see Treap.flatten.
+
+    Node i has the key key[i] and the children left[i] and right[i] (NIL if
+    missing). Its canonical subset consists of the segments with the ids
+    can_ids[can_offsets[i]:can_offsets[i + 1]], see SegmentTable.
+    """
+    def __init__(self, root, key, left, right, cans):
+        """Return a FlatTreap with the given root index, per node keys and
+        child indices, and per node canonical subsets of Segment handles 
+        (iterables or None)."""
+        self.root = root
+        self.key = np.array(key, dtype = np.float64)
+        self.left = np.array(left, dtype = np.int64)
+        self.right = np.array(right, dtype = np.int64)
+        can_ids = []
+        sizes = np.zeros(len(self.key), dtype = np.int64)
+        for node, can in enumerate(cans):
+            if not can:
+                continue
+            sizes[node] = len(can)
+            can_ids.extend(segment.id for segment in can)
+        self.can_offsets = np.zeros(len(self.key) + 1, dtype = np.int64)
+        np.cumsum(sizes, out = self.can_offsets[1:])
+        self.can_ids = np.array(can_ids, dtype = np.int64)
+
+    def paths(self, points):
+        """Yield, level by level, the pair of query indices and nodes of all
+        search paths for points that reach that level."""
+        position = np.arange(len(points))
+        node = np.full(len(points), self.root, dtype = np.int64)
+        while len(position):
+            yield position, node
+            ## the comparison of Treap.find_leaf, for all points at once
+            node = np.where(points[position] < self.key[node], self.left[node], self.right[node])
+            reached = node != NIL
+            position, node = position[reached], node[reached]
+
+    def count_many(self, points):
+        """Return an array of the number of segments that contain each of
+        points. Only the sizes of the canonical subsets are summed."""
+        points = np.asarray(points, dtype = np.float64)
+        sizes = np.diff(self.can_offsets)
+        counts = np.zeros(len(points), dtype = np.int64)
+        for position, node in self.paths(points):
+            counts[position] += sizes[node]
+        return counts
+
+    def stab_many(self, points):
+        """Return the segments that contain each of points in CSR form, i.e.
+        a pair of arrays offsets and ids such that the segments containing
+        points[i] have the ids ids[offsets[i]:offsets[i + 1]].
+        """
+        points = np.asarray(points, dtype = np.float64)
+        sizes = np.diff(self.can_offsets)
+        counts = self.count_many(points)
+        offsets = np.zeros(len(points) + 1, dtype = np.int64)
+        np.cumsum(counts, out = offsets[1:])
+        ids = np.empty(offsets[-1], dtype = np.int64)
+        ## second descent: copy each canonical subset on the path to the
+        ## next free slot of its query point
+        fill = offsets[:-1].copy()
+        for position, node in self.paths(points):
+            size = sizes[node]
+            nonempty = size > 0
+            position, node, size = position[nonempty], node[nonempty], size[nonempty]
+            if not len(size):
+                continue
+            block_start = np.cumsum(size) - size
+            within = np.arange(size.sum()) - np.repeat(block_start, size)
+            ids[np.repeat(fill[position], size) + within] = \
+                self.can_ids[np.repeat(self.can_offsets[node], size) + within]
+            fill[position] += size
+        return offsets, ids
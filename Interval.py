@@ -23,6 +23,8 @@ n_inf = - float("inf")
 
 class Interval:
     """An interval object that is used for both segments and intervals"""
+    __slots__ = ('left', 'right')
+
     def __init__(self, left=n_inf, right=p_inf):
         if left > right:
             print(left, right)
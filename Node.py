@@ -14,6 +14,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import random
+from operator import attrgetter
 
 from Interval import Interval, n_inf, p_inf
 
@@ -21,10 +22,34 @@ from Interval import Interval, n_inf, p_inf
 def generate_priority():
     return random.random()
 
+## shared canonical subset of all nodes whose canonical subset is empty
+_empty_can = frozenset()
+
+_tag = attrgetter('tag')
+_id = attrgetter('id')
+
+def segment_ids(can):
+    """Return the set of ids of the Segment handles in can (or None)."""
+    return set(map(_id, can)) if can else set()
+
+def can_fingerprint(can):
+    """Return a hash of a canonical subset of Segment handles (or None),
+    the sum of their tags. It does not depend on the order of the set and
+    is the same for handles with the same ids in different tables."""
+    return sum(map(_tag, can)) if can else 0
+
+def node_fingerprint(key, priority, low, high, can_hash, left, right):
+    """Return the Merkle-style fingerprint of a node from its fields, the
+    can_fingerprint of its canonical subset and the fingerprints of its
+    children (0 for a missing child)."""
+    return hash((key, priority, low, high, can_hash, left, right))
+
 class Node():
     """A class for nodes of segment treaps without parent pointers,
     i.e. for insertions using zipping.
     """
+    __slots__ = ('key', 'priority', 'left', 'right', 'interval_left', 'interval_right', '_can', 'belonging_segment', '_fingerprint', '_can_hash', '_max_cover', '_weights')
+
     def __init__(self, key, priority, left = None, right = None, associated_interval = None, can = None, belonging_segment = None):
         """Initialize a class object, i.e. a segment tree node.
         
@@ -51,18 +76,98 @@ class Node():
         self.right = right
         self.belonging_segment = belonging_segment
         if associated_interval is None:
-            self.associated_interval = Interval()
+            self.interval_left = n_inf
+            self.interval_right = p_inf
         else:
             self.associated_interval = associated_interval
-        if can is None:
-            self.can = set()
-        else:
-            self.can = can
+        ## None while stale, see Treap.fingerprint, Treap.max_overlap and
+        ## Treap.update_weights
+        self._fingerprint = None
+        self._max_cover = None
+        self._weights = None
+        self.can = can
         if priority == None:
             self.priority = generate_priority()
         else:
             self.priority = priority
 
+    @property
+    def associated_interval(self):
+        """The associated interval of the node as a new Interval object. 
+        It is stored in the two fields interval_left and interval_right.
+        """
+        return Interval(self.interval_left, self.interval_right)
+
+    @associated_interval.setter
+    def associated_interval(self, interval):
+        self.interval_left = interval.left
+        self.interval_right = interval.right
+
+    @property
+    def can(self):
+        """The canonical subset of the node. No set is allocated while it is
+        empty, an empty frozenset is returned instead, so it may not be
+        changed in place. Use add_to_can, add_all_to_can and discard_from_can
+        instead, or assign a new set, which also keeps the cached hash of
+        the canonical subset right.
+        """
+        if self._can is None:
+            return _empty_can
+        return self._can
+
+    @can.setter
+    def can(self, segments):
+        self._can_hash = None
+        if not segments:
+            self._can = None
+        elif type(segments) is set:
+            self._can = segments
+        else:
+            self._can = set(segments)
+
+    def add_to_can(self, segment):
+        """Add segment to the canonical subset of self. Nodes with an empty
+        associated interval, which arise from equal keys, contain no point
+        and keep their canonical subsets empty."""
+        if self.interval_left == self.interval_right:
+            return
+        if self._can is None:
+            self._can = {segment}
+            self._can_hash = segment.tag
+        else:
+            size = len(self._can)
+            self._can.add(segment)
+            if self._can_hash is not None and len(self._can) > size:
+                self._can_hash += segment.tag
+
+    def add_all_to_can(self, segments):
+        """Add the segments to the canonical subset of self at once, see 
+        add_to_can."""
+        if not segments or self.interval_left == self.interval_right:
+            return
+        if self._can is None:
+            self._can = set(segments)
+            self._can_hash = sum(map(_tag, self._can))
+        else:
+            size = len(self._can)
+            self._can.update(segments)
+            if self._can_hash is not None:
+                if len(self._can) == size + len(segments):
+                    self._can_hash += sum(map(_tag, segments))
+                else:
+                    self._can_hash = None
+
+    def discard_from_can(self, segment):
+        """Remove segment from the canonical subset of self if it is there."""
+        if self._can is not None:
+            size = len(self._can)
+            self._can.discard(segment)
+            if not self._can:
+                self._can = None
+                self._can_hash = 0
+            elif self._can_hash is not None and len(self._can) < size:
+                self._can_hash -= segment.tag
+
     def __lt__(self, other):
         return self.key < other.key
 
@@ -72,16 +177,30 @@ class Node():
         return self.key > other.key
 
     def __eq__(self, other):
-        if other == None:
-            return False
-        if self.key == other.key and self.left == other.left and self.right \
-        == other.right and self.priority == other.priority and \
-        self.associated_interval.left == other.associated_interval.left and \
-        self.associated_interval.right == other.associated_interval.right and \
-        self.can == other.can: 
-            return True 
-        else:
-            return False
+        """Return True iff the subtrees of self and other have the same 
+        structure, keys, priorities, associated intervals and canonical 
+        subsets. Canonical subsets are compared by segment ids.
+        """
+        ## two explicit stacks in lockstep instead of recursing into children
+        stack = [self]
+        other_stack = [other]
+        while stack:
+            node = stack.pop()
+            other = other_stack.pop()
+            if node is other:
+                continue
+            if node is None or other is None:
+                return False
+            if node.key != other.key or node.priority != other.priority or \
+            node.interval_left != other.interval_left or \
+            node.interval_right != other.interval_right or \
+            segment_ids(node._can) != segment_ids(other._can):
+                return False
+            stack.append(node.right)
+            other_stack.append(other.right)
+            stack.append(node.left)
+            other_stack.append(other.left)
+        return True
     def __le__(self, other):
         return self < other or self == other     
     def __ge__(self, other):
@@ -91,9 +210,16 @@ class Node():
             return str(self.key) + "," + str(self.associated_interval)
         return str(self.key) + "," + str(self.associated_interval) + "," + str(self.can)
 
+    def can_fingerprint(self):
+        """Return can_fingerprint(self.can). It is cached until the 
+        canonical subset changes."""
+        if self._can_hash is None:
+            self._can_hash = can_fingerprint(self._can)
+        return self._can_hash
+
     def is_leaf(self):
         """Return True iff self is a leaf."""
-        return self.left == None and self.right == None
+        return self.left is None and self.right is None
 
     def display_priority(self):
         if self.priority == n_inf:
@@ -104,27 +230,25 @@ class Node():
     def traverse(self):
         """Return the set of all segments that belong to a leaf in self's subtree.
         """
-        if self.is_leaf():
-            if self.belonging_segment is None:
-                ## We are at the dummy node
-                return set()
+        segments = set()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.left is None and node.right is None:
+                ## The dummy leaf has no belonging segment.
+                if node.belonging_segment is not None:
+                    segments.add(node.belonging_segment)
             else:
-                return {self.belonging_segment}
-        else:
-            return self.left.traverse().union(self.right.traverse())
+                stack.append(node.left)
+                stack.append(node.right)
+        return segments
 
     def update_can(self, parent):
         """Looks through all segments in self.can. Deletes all that do not
         fulfill the definition of the canonical subset.
         """
-        segments = list(self.can)
         #print("Update", self, "with parent", parent, ". Segments in Question:", segments)
-        self.can = set()
-        int_self = self.associated_interval
-        int_par = parent.associated_interval
-        for segment in segments: 
-            if segment.covers(int_self) and not segment.covers(int_par):
-                self.can.add(segment)
+        self.find_can(parent, list(self.can))
         #print(self.can)
         # print("Appropriate segments:", self.can)
 
@@ -133,28 +257,34 @@ class Node():
         the canonical subset.
         """
         # print("Update", self, "with parent", parent, ". Segments in Question:", segments)
-        self.can = set()
-        int_self = self.associated_interval
-        int_par = parent.associated_interval
+        low, high = self.interval_left, self.interval_right
+        parent_low, parent_high = parent.interval_left, parent.interval_right
+        can = set()
         for segment in segments: 
-            if segment.covers(int_self) and not segment.covers(int_par):
-                self.can.add(segment)
+            if low < high and segment.left <= low and high <= segment.right and \
+            not (segment.left <= parent_low and parent_high <= segment.right):
+                can.add(segment)
+        self.can = can
         # print("Appropriate segments:", self.can)
 
     def pull_segments_from_child(self, child, parent):
         """Delete the appropriate segments of the canonical subset of 
         non-search-path child child and of the just deleted segments, add those
         to self.can, that fulfill the definition of the canonical subset.
+        Return the number of segments taken from child.
         """ 
         #print("pull: before:", self, child, parent)
         if child == None:
-            return
+            return 0
+        moved = 0
         segments = list(child.can)
         for segment in segments:
-            if segment.covers(self.associated_interval):
-                child.can.remove(segment)
-                if not segment.covers(parent.associated_interval):
-                    self.can.add(segment)
+            if self.is_covered_by(segment):
+                child.discard_from_can(segment)
+                moved += 1
+                if not parent.is_covered_by(segment):
+                    self.add_to_can(segment)
+        return moved
 
         #print("pull: after:", self, child, parent)
 
@@ -162,65 +292,147 @@ class Node():
         """Return list of strings, width, height, and horizontal coordinate of the root. 
         This was copied from 
         https://stackoverflow.com/questions/34012886/print-binary-tree-level-by-level-in-python."""
-        # No child.
-        if self.right is None and self.left is None:
-            line = str(self)
-            width = len(line)
-            height = 1
-            middle = width // 2
-            return [line], width, height, middle
-        # Only left child.
-        if self.right is None:
-            lines, n, p, x = self.left._display_aux()
-            s = str(self)
-            u = len(s)
-            first_line = (x + 1) * ' ' + (n - x - 1) * '_' + s
-            second_line = x * ' ' + '/' + (n - x - 1 + u) * ' '
-            shifted_lines = [line + u * ' ' for line in lines]
-            return [first_line, second_line] + shifted_lines, n + u, p + 2, n + u // 2
-        # Only right child.
-        if self.left is None:
-            lines, n, p, x = self.right._display_aux()
-            s = str(self)
+        ## Nodes are laid out in postorder with an explicit stack, so that
+        ## both children are done before their parent.
+        results = {}
+        stack = [(self, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if not children_done:
+                stack.append((node, True))
+                if node.right is not None:
+                    stack.append((node.right, False))
+                if node.left is not None:
+                    stack.append((node.left, False))
+                continue
+            s = str(node)
             u = len(s)
-            first_line = s + x * '_' + (n - x) * ' '
-            second_line = (u + x) * ' ' + '\\' + (n - x - 1) * ' '
-            shifted_lines = [u * ' ' + line for line in lines]
-            return [first_line, second_line] + shifted_lines, n + u, p + 2, u // 2
-        # Two children.
-        left, n, p, x = self.left._display_aux()
-        right, m, q, y = self.right._display_aux()
-        s = str(self)
-        u = len(s)
-        first_line = (x + 1) * ' ' + (n - x - 1) * '_' + s + y * '_' + (m - y) * ' '
-        second_line = x * ' ' + '/' + (n - x - 1 + u + y) * ' ' + '\\' + (m - y - 1) * ' '
-        if p < q:
-            left += [n * ' '] * (q - p)
-        elif q < p:
-            right += [m * ' '] * (p - q)
-        zipped_lines = zip(left, right)
-        lines = [first_line, second_line] + [a + u * ' ' + b for a, b in zipped_lines]
-        return lines, n + m + u, max(p, q) + 2, n + u // 2
+            # No child.
+            if node.right is None and node.left is None:
+                results[id(node)] = [s], u, 1, u // 2
+            # Only left child.
+            elif node.right is None:
+                lines, n, p, x = results.pop(id(node.left))
+                first_line = (x + 1) * ' ' + (n - x - 1) * '_' + s
+                second_line = x * ' ' + '/' + (n - x - 1 + u) * ' '
+                shifted_lines = [line + u * ' ' for line in lines]
+                results[id(node)] = [first_line, second_line] + shifted_lines, n + u, p + 2, n + u // 2
+            # Only right child.
+            elif node.left is None:
+                lines, n, p, x = results.pop(id(node.right))
+                first_line = s + x * '_' + (n - x) * ' '
+                second_line = (u + x) * ' ' + '\\' + (n - x - 1) * ' '
+                shifted_lines = [u * ' ' + line for line in lines]
+                results[id(node)] = [first_line, second_line] + shifted_lines, n + u, p + 2, u // 2
+            # Two children.
+            else:
+                left, n, p, x = results.pop(id(node.left))
+                right, m, q, y = results.pop(id(node.right))
+                first_line = (x + 1) * ' ' + (n - x - 1) * '_' + s + y * '_' + (m - y) * ' '
+                second_line = x * ' ' + '/' + (n - x - 1 + u + y) * ' ' + '\\' + (m - y - 1) * ' '
+                if p < q:
+                    left += [n * ' '] * (q - p)
+                elif q < p:
+                    right += [m * ' '] * (p - q)
+                zipped_lines = zip(left, right)
+                lines = [first_line, second_line] + [a + u * ' ' + b for a, b in zipped_lines]
+                results[id(node)] = lines, n + m + u, max(p, q) + 2, n + u // 2
+        return results[id(self)]
 
     def is_covered_by(self, segment):
         """Return True iff segment covers self.
         """
-        return segment.covers(self.associated_interval)
+        return segment.left <= self.interval_left and self.interval_right <= segment.right
+
+    def intersects(self, segment):
+        """Return True iff segment intersects self's associated interval.
+        """
+        return self.interval_right > segment.left and self.interval_left < segment.right
 
     def add_segment_to_cans(self, segment, debug_treap=None):
         """Add segment to appropriate canonical subsets in subtree with root self.
         """
-        # print("check: ",self, segment)
-        if self.is_covered_by(segment):
-            # print("add")
-            self.can.add(segment)
-            # print("Add segment", segment, "to can of", self)
-            #debug_treap.display()
-        else:
-            if self.left is not None and self.left.associated_interval.intersects(segment):
-                self.left.add_segment_to_cans(segment, debug_treap)
-            if self.right is not None and self.right.associated_interval.intersects(segment):
-                self.right.add_segment_to_cans(segment, debug_treap)
+        left, right = segment.left, segment.right
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if left <= node.interval_left and node.interval_right <= right:
+                node.add_to_can(segment)
+                continue
+            ## Children intersect segment iff it crosses the split key.
+            if node.left is not None and left < node.key:
+                stack.append(node.left)
+            if node.right is not None and right > node.key:
+                stack.append(node.right)
+
+    def add_segments_to_cans(self, segments, pending = None):
+        """Add all segments to appropriate canonical subsets in subtree with
+        root self in one top-down sweep. If pending is given, only descend
+        from nodes whose id is in pending.
+        """
+        stack = [(self, list(segments))]
+        while stack:
+            node, segments = stack.pop()
+            low = node.interval_left
+            high = node.interval_right
+            if pending is not None and id(node) not in pending:
+                ## only add, do not descend
+                node.add_all_to_can([segment for segment in segments if segment.left <= low and high <= segment.right])
+                continue
+            ## The children's intervals meet at node.key.
+            key = node.key
+            covering = []
+            left_segments = []
+            right_segments = []
+            for segment in segments:
+                if segment.left <= low and high <= segment.right:
+                    covering.append(segment)
+                else:
+                    if segment.left < key:
+                        left_segments.append(segment)
+                    if segment.right > key:
+                        right_segments.append(segment)
+            node.add_all_to_can(covering)
+            if left_segments and node.left is not None:
+                stack.append((node.left, left_segments))
+            if right_segments and node.right is not None:
+                stack.append((node.right, right_segments))
+
+    def add_segment_to_spine_cans(self, segment, key):
+        """Add segment to appropriate canonical subsets in subtree with root self,
+        but only descend into nodes whose associated interval starts or ends 
+        at key, i.e. into the spines of a zipping at key. The canonical 
+        subsets further down are not affected by the zipping.
+        """
+        left, right = segment.left, segment.right
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            low, high = node.interval_left, node.interval_right
+            if high <= left or low >= right:
+                continue
+            if left <= low and high <= right:
+                node.add_to_can(segment)
+            elif low == key or high == key:
+                if node.left is not None:
+                    stack.append(node.left)
+                if node.right is not None:
+                    stack.append(node.right)
+
+    def remove_segment_from_cans(self, segment):
+        """Remove segment from all canonical subsets in subtree with root self.
+        """
+        left, right = segment.left, segment.right
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if left <= node.interval_left and node.interval_right <= right:
+                node.discard_from_can(segment)
+                continue
+            if node.left is not None and left < node.key:
+                stack.append(node.left)
+            if node.right is not None and right > node.key:
+                stack.append(node.right)
 
     def union_of_children_intervals(self):
         """Return the union of self's children's intervals."""
@@ -237,7 +449,9 @@ class pNode(Node):
     """A class for nodes of segment treaps with parent pointers,
      i.e. for insertions using rotations.
      """
-    def __init__(self, key, priority, parent = None, left = None, right = None, associated_interval = Interval(), can = set()):
+    __slots__ = ('parent',)
+
+    def __init__(self, key, priority, parent = None, left = None, right = None, associated_interval = Interval(), can = set(), belonging_segment = None):
         """Initialize a class object, i.e. a segment tree node with parent pointer.
         
         Parameters:
@@ -260,6 +474,69 @@ class pNode(Node):
         Returns:
             A segment tree node with parent pointer
         """
-        super().__init__(key, priority, left = None, right = None, associated_interval = Interval(), can = set())
+        super().__init__(key, priority, left = None, right = None, associated_interval = Interval(), can = set(), belonging_segment = belonging_segment)
         self.parent = parent
 
+
+class PersistentNode(Node):
+    """A class for nodes of persistent segment treaps. A node may be shared
+    by several versions of a treap and is only changed by the version it
+    was made for, see Treap.PersistentTreap.
+
+    Canonical subsets are shared as well. A node that may share its 
+    canonical subset copies it before changing it in place.
+    """
+    __slots__ = ('version', 'owns_can')
+
+    def __init__(self, key, priority, left = None, right = None, associated_interval = None, can = None, belonging_segment = None):
+        """Initialize a segment tree node that belongs to no version yet, 
+        see PersistentTreap.new_node. The parameters are those of Node."""
+        super().__init__(key, priority, left, right, associated_interval, can, belonging_segment)
+        self.version = None
+
+    @property
+    def can(self):
+        """The canonical subset of the node, see Node.can."""
+        if self._can is None:
+            return _empty_can
+        return self._can
+
+    @can.setter
+    def can(self, segments):
+        ## The set may come from another node.
+        Node.can.fset(self, segments)
+        self.owns_can = False
+
+    def add_to_can(self, segment):
+        """Add segment to the canonical subset of self."""
+        if not self.owns_can:
+            self.own_can()
+        super().add_to_can(segment)
+
+    def add_all_to_can(self, segments):
+        """Add the segments to the canonical subset of self."""
+        if not self.owns_can:
+            self.own_can()
+        super().add_all_to_can(segments)
+
+    def discard_from_can(self, segment):
+        """Remove segment from the canonical subset of self if it is there."""
+        if not self.owns_can:
+            self.own_can()
+        super().discard_from_can(segment)
+
+    def own_can(self):
+        """Replace the canonical subset of self by a copy of its own."""
+        if self._can is not None:
+            self._can = set(self._can)
+        self.owns_can = True
+
+    def copy(self, version):
+        """Return a copy of self for the given version. The children and
+        the canonical subset are shared."""
+        copy = PersistentNode.__new__(PersistentNode)
+        for slot in Node.__slots__:
+            setattr(copy, slot, getattr(self, slot))
+        copy.owns_can = False
+        copy.version = version
+        return copy
@@ -0,0 +1,125 @@
+# Copyright (C) 2020  Johannes Wolf
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from Interval import Interval
+
+
+class Segment(Interval):
+    """A handle for a segment in a segment treap. It has the integer id
+    that its SegmentTable assigned to it (None while it is in no table), a
+    well-mixed hash tag of that id for fingerprints (see 
+    Node.can_fingerprint), a weight (1 by default, see Treap.weight_at) and
+    an arbitrary payload of the caller.
+
+    Handles are only equal to themselves and hash by identity in C, which
+    keeps the set algebra on canonical subsets cheap. Two segments with the
+    same bounds are two different handles.
+    """
+    __slots__ = ('id', 'tag', 'payload', 'weight')
+
+    __hash__ = object.__hash__
+    __eq__ = object.__eq__
+
+    def __init__(self, left, right, payload = None, weight = 1):
+        super().__init__(left, right)
+        self.id = None
+        self.tag = None
+        self.payload = payload
+        self.weight = weight
+
+    def __repr__(self):
+        return "#" + str(self.id) + "(" + super().__repr__() + ")"
+
+
+class SegmentTable:
+    """The segments of a segment treap with dense integer ids. The ids of
+    removed segments are reused.
+    """
+    ## False if removed segments keep their ids and tags, which are then 
+    ## never reused, see PersistentSegmentTable
+    reuse_ids = True
+
+    def __init__(self):
+        """Return an empty SegmentTable."""
+        self.segments = []
+        self.free = []
+
+    def __len__(self):
+        """Return the number of segments in self."""
+        return len(self.segments) - len(self.free)
+
+    def __iter__(self):
+        """Yield all segments in self by id."""
+        for segment in self.segments:
+            if segment is not None:
+                yield segment
+
+    def __getitem__(self, id):
+        """Return the segment with the given id."""
+        segment = self.segments[id]
+        if segment is None:
+            raise KeyError(id)
+        return segment
+
+    def __contains__(self, segment):
+        """Return True iff segment is a handle in self."""
+        return isinstance(segment, Segment) and segment.id is not None and \
+            segment.id < len(self.segments) and self.segments[segment.id] is segment
+
+    def check_writable(self):
+        """Raise TypeError if self cannot be changed. Every table can be
+        changed, but see Storage.MappedSegmentTable."""
+
+    def add(self, segment, payload = None, weight = None):
+        """Add segment to self and return its handle.
+
+        A Segment that is in no table yet becomes the handle itself,
+        otherwise a new handle with the same bounds is made. payload and
+        weight replace the handle's payload and weight unless they are None.
+        """
+        if segment in self:
+            raise ValueError("segment is already in the table: %r" % (segment,))
+        if not isinstance(segment, Segment) or segment.id is not None:
+            segment = Segment(segment.left, segment.right, getattr(segment, 'payload', None), getattr(segment, 'weight', 1))
+        if payload is not None:
+            segment.payload = payload
+        if weight is not None:
+            segment.weight = weight
+        if self.free and self.reuse_ids:
+            segment.id = self.free.pop()
+            self.segments[segment.id] = segment
+        else:
+            segment.id = len(self.segments)
+            self.segments.append(segment)
+        segment.tag = hash((segment.id, -segment.id))
+        return segment
+
+    def remove(self, segment):
+        """Remove the handle segment from self. Its id is freed."""
+        if segment not in self:
+            raise KeyError(segment)
+        self.segments[segment.id] = None
+        self.free.append(segment.id)
+        if self.reuse_ids:
+            segment.id = None
+            segment.tag = None
+
+
+class PersistentSegmentTable(SegmentTable):
+    """The segments of a persistent segment treap. Snapshots may still hold
+    removed segments, so they keep their ids and tags, and the ids are not
+    reused.
+    """
+    reuse_ids = False
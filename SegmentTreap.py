@@ -13,53 +13,558 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from Treap import Treap, pTreap
-from Node import Node, pNode
+import bisect
+import gc
+import heapq
+import itertools
+import multiprocessing
+import threading
+from contextlib import contextmanager
+
+from Treap import Treap, pTreap, PersistentTreap
+from ArrayTreap import ArrayTreap
+from Node import Node, pNode, generate_priority
 from Interval import n_inf, p_inf, Interval
+from Segment import SegmentTable, PersistentSegmentTable
+
+
+@contextmanager
+def gc_paused():
+    """Disable the cyclic garbage collector while the block runs. A batch
+    allocates many objects that stay alive, and each full collection they 
+    trigger scans the whole treap again."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def sorted_endpoints(segments, priorities = None):
+    """Return the endpoints of segments as triples of key, priority and 
+    belonging segment, sorted by key. 
+
+    priorities is an optional iterable of pairs (prio1, prio2) as they would
+    be passed to insert. Missing priorities are generated.
+    """
+    if priorities is None:
+        priorities = ((None, None) for segment in segments)
+    endpoints = []
+    for segment, (prio1, prio2) in zip(segments, priorities):
+        if prio1 is None:
+            prio1 = generate_priority()
+        if prio2 is None:
+            prio2 = generate_priority()
+        endpoints.append((segment.left, prio1, segment))
+        endpoints.append((segment.right, prio2, segment))
+    endpoints.sort(key = lambda endpoint: endpoint[0])
+    return endpoints
+
+
+## order of the events of all_intersections at the same coordinate
+END, START = 0, 1
+
+
+def all_intersections(segments):
+    """Yield every pair of segments that intersect (see Interval.intersects)
+    exactly once, as the segment that starts first and the other one.
+    Empty segments contain no point and are in no pair, as they are never
+    returned by the queries of a segment treap, see Treap.iter_overlap.
+
+    A sweep line passes the sorted endpoints. The segments that intersect 
+    a segment starting at x are those that contain x, i.e. exactly those a
+    stabbing query at x would return from a segment treap of the segments 
+    the sweep line is in. So they are kept in a dict instead, which makes 
+    the sweep take O(n log n + k) time for k pairs and O(n) memory. The 
+    pairs are yielded as they are found.
+    """
+    events = []
+    for i, segment in enumerate(segments):
+        if segment.left < segment.right:
+            events.append((segment.left, START, i, segment))
+            events.append((segment.right, END, i, segment))
+    events.sort(key = lambda event: event[:3])
+    active = {}
+    for x, kind, i, segment in events:
+        if kind == END:
+            del active[i]
+            continue
+        for other in active.values():
+            yield other, segment
+        active[i] = segment
+
 
+class SegmentTreapBase:
+    """The operations shared by all segment treap objects. A subclass sets
+    up self.treap and self.segments and may change how an endpoint is
+    inserted, see insert_endpoint."""
+    ## insert_many merges a batch into the treap if it has at least 
+    ## merge_ratio times as many segments as self, see insert_many. Below,
+    ## inserting one by one was faster on uniform random segments.
+    merge_ratio = 1 / 4
+    @classmethod
+    def from_segments(cls, segments, priorities = None, **options):
+        """Return a segment treap that contains segments.
 
-class pSegmentTreap:
+        The endpoints are sorted once and the treap is built bottom-up (see
+        Treap.build), then the segments are distributed to the canonical 
+        subsets. This takes O(n log n) expected time. For distinct endpoints 
+        and equal priorities, the result is identical to inserting the 
+        segments one by one. options are passed to the constructor.
+        """
+        tree = cls(**options)
+        segments = [tree.register(segment) for segment in segments]
+        tree.treap.build(sorted_endpoints(segments, priorities))
+        for segment in segments:
+            tree.treap.add_segment_to_cans(segment)
+        return tree
+    def save(self, path):
+        """Write self to the file path in a compact binary layout, see 
+        Storage.save."""
+        from Storage import save
+        save(self, path)
+    @classmethod
+    def load(cls, path, mmap = True):
+        """Return the segment treap saved to the file path. With mmap it is
+        a read-only view of the file that loads in O(1), see Storage.load."""
+        from Storage import load
+        return load(path, mmap)
+    def display(self):
+        self.treap.display()
+    def __eq__(self, other):
+        return self.treap == other.treap
+    def fingerprint(self):
+        """Return a hash of the structure and canonical subsets of self that
+        is equal for equal segment treaps, see Treap.fingerprint."""
+        return self.treap.fingerprint()
+    def recording(self):
+        """Return a context manager that counts what the updates of self do,
+        see Treap.recording."""
+        return self.treap.recording()
+    def analyze(self):
+        """Return a report on the shape of self and the memory of its 
+        canonical subsets, see Treap.analyze."""
+        return self.treap.analyze()
+    def all_intersections(self):
+        """Yield every pair of segments of self that intersect once, see
+        all_intersections."""
+        return all_intersections(self.segments)
+    def stab(self, point):
+        """Return the set of all segments that contain point."""
+        return self.treap.stab(point)
+    def iter_stab(self, point):
+        """Yield all segments that contain point, one at a time."""
+        return self.treap.iter_stab(point)
+    def count(self, point):
+        """Return the number of segments that contain point."""
+        return self.treap.count(point)
+    def max_overlap(self):
+        """Return the maximum number of segments that contain a common point
+        and the smallest such point, see Treap.max_overlap."""
+        return self.treap.max_overlap()
+    def weight_at(self, point):
+        """Return the total weight of the segments that contain point."""
+        return self.treap.weight_at(point)
+    def max_weight_in(self, interval):
+        """Return the maximum total weight of the segments that contain a 
+        common point of interval and the smallest such point, see 
+        Treap.max_weight_in."""
+        return self.treap.max_weight_in(interval)
+    def stab_many(self, points):
+        """Return the segments that contain each of points as a pair of
+        arrays offsets and ids, such that the segments containing points[i]
+        have the ids ids[offsets[i]:offsets[i + 1]] in self.segments."""
+        return self.treap.stab_many(points)
+    def count_many(self, points):
+        """Return an array of the number of segments that contain each of
+        points."""
+        return self.treap.count_many(points)
+    def query_overlap(self, interval):
+        """Return the set of all segments that intersect interval. Empty
+        segments are never returned, see Treap.iter_overlap."""
+        return self.treap.query_overlap(interval)
+    def iter_overlap(self, interval):
+        """Yield all segments that intersect interval, one at a time. Empty
+        segments are never returned, see Treap.iter_overlap."""
+        return self.treap.iter_overlap(interval)
+    def register(self, segment, payload = None, weight = None):
+        """Add segment to self.segments and return its handle, see 
+        SegmentTable.add. All updates add their segments here."""
+        return self.segments.add(segment, payload, weight)
+    def insert_endpoint(self, key, priority, segment):
+        """Insert an endpoint of segment into the treap as an inner node and
+        a leaf."""
+        self.treap.insert_inner_and_leaf(key, priority, segment)
+    def insert(self, segment, prio1= None, prio2= None, payload = None, weight = None):
+        """Insert segment with an optional payload and weight and return its
+        handle, see SegmentTable.add."""
+        segment = self.register(segment, payload, weight)
+        self.insert_endpoint(segment.left, prio1, segment)
+        self.insert_endpoint(segment.right, prio2, segment)
+        self.treap.add_segment_to_cans(segment)
+        return segment
+    def insert_many(self, segments, priorities = None, payloads = None, weights = None):
+        """Insert all segments at once, with optional payloads and weights,
+        and return the list of their handles.
+
+        The endpoints are sorted and merged into the treap in one structural
+        pass (see Treap.merge). Then the new segments are distributed to the
+        canonical subsets in one top-down sweep. This only pays off when the
+        batch is not much smaller than the treap, see merge_ratio. Smaller
+        batches are inserted one by one.
+        """
+        segments = list(segments)
+        if payloads is None:
+            payloads = [None] * len(segments)
+        if weights is None:
+            weights = [None] * len(segments)
+        if len(segments) < self.merge_ratio * len(self.segments):
+            if priorities is None:
+                priorities = [(None, None)] * len(segments)
+            return [self.insert(segment, prio1, prio2, payload, weight) for segment, (prio1, prio2), payload, weight
+                in zip(segments, priorities, payloads, weights)]
+        with gc_paused():
+            segments = [self.register(segment, payload, weight) for segment, payload, weight in zip(segments, payloads, weights)]
+            self.treap.merge(sorted_endpoints(segments, priorities))
+            self.treap.add_segments_to_cans(segments)
+        return segments
+    def delete(self, segment):
+        """Delete segment, which has to be the handle returned by insert."""
+        if segment not in self.segments:
+            raise KeyError(segment)
+        ## before anything changes
+        self.segments.check_writable()
+        self.treap.remove_segment_from_cans(segment)
+        self.treap.delete_inner_and_leaf(segment.left, segment)
+        self.treap.delete_inner_and_leaf(segment.right, segment)
+        self.segments.remove(segment)
+
+
+class pSegmentTreap(SegmentTreapBase):
     """An segment treap object that uses rotations for insertion"""
     def __init__(self):
         self.treap = pTreap()
         self.treap.root = pNode(n_inf, n_inf)
-    def __eq__(self, other):
-    	return self.treap == other.treap
-    def display(self):
-    	self.treap.display()
-    def insert(self, segment, prio1= None, prio2= None):
-        self.treap.insert_inner_and_leaf(segment.left, prio1)
-        self.treap.insert_inner_and_leaf(segment.right, prio2)
-        self.treap.root.add_segment_to_cans(segment, self.treap)
+        self.segments = SegmentTable()
 
 
-class SegmentTreap:
+class SegmentTreap(SegmentTreapBase):
     """An segment treap object that uses classic zipping for insertion"""
-    def __init__(self):
-        self.treap = Treap()
-        self.treap.root = Node(n_inf, n_inf)
-    def display(self):
-    	self.treap.display()
-    def __eq__(self, other):
-    	return self.treap == other.treap
-    def insert(self, segment, prio1= None, prio2= None):
-        self.treap.insert_inner_and_leaf(segment.left, prio1, segment)
-        self.treap.insert_inner_and_leaf(segment.right, prio2, segment)            
-        self.treap.root.add_segment_to_cans(segment, self.treap)
+    ## Classic zipping one by one is slower than the other variants.
+    merge_ratio = 1 / 16
+    def __init__(self, backend = "nodes"):
+        """Return an empty segment treap. backend is "nodes" for a treap of
+        Node objects or "array" for an ArrayTreap, which keeps all nodes in
+        flat arrays.
+        """
+        if backend == "nodes":
+            self.treap = Treap()
+            self.treap.root = Node(n_inf, n_inf)
+        elif backend == "array":
+            self.treap = ArrayTreap()
+        else:
+            raise ValueError("unknown backend: %r" % (backend,))
+        self.segments = SegmentTable()
 
 
-class cSegmentTreap:
+class cSegmentTreap(SegmentTreapBase):
     """An segment treap object that uses complex zipping for insertion"""
     def __init__(self):
         self.treap = Treap()
         self.treap.root = Node(n_inf, n_inf)
-    def display(self):
-        self.treap.display()
-    def __eq__(self, other):
-        return self.treap == other.treap
-    def insert(self, segment, prio1= None, prio2= None):
-        self.treap.complexinsert_inner_and_leaf(segment.left, prio1, segment)
-        self.treap.complexinsert_inner_and_leaf(segment.right, prio2, segment)            
-        self.treap.root.add_segment_to_cans(segment, self.treap)
-        #print("segment added to cans")
-        #self.display()
+        self.segments = SegmentTable()
+    def insert_endpoint(self, key, priority, segment):
+        """Insert an endpoint of segment with complex zipping."""
+        self.treap.complexinsert_inner_and_leaf(key, priority, segment)
+
+
+class PersistentSegmentTreap(SegmentTreap):
+    """An segment treap object that uses classic zipping for insertion and
+    keeps old versions readable, see snapshot"""
+    def __init__(self):
+        self.treap = PersistentTreap()
+        self.treap.root = self.treap.new_node(n_inf, n_inf)
+        ## snapshots may still hold deleted segments
+        self.segments = PersistentSegmentTable()
+    def snapshot(self):
+        """Return a read-only view of the current segments in O(1). Later
+        changes of self do not show in it, see PersistentTreap.snapshot."""
+        return self.treap.snapshot()
+
+
+class WindowedSegmentTreap(SegmentTreap):
+    """A segment treap that uses classic zipping for insertion and drops 
+    the segments that end before a moving watermark, see expire.
+
+    The segments are also kept in a min-heap by their right endpoints, 
+    since they do not end in the order of the keys of the treap. Each 
+    segment is pushed and popped once, so an eviction takes amortized 
+    O(log n) expected time besides its delete.
+    """
+    def __init__(self, backend = "nodes"):
+        """Return an empty windowed segment treap, see SegmentTreap."""
+        super().__init__(backend)
+        ## entries (right, order of insertion, handle)
+        self.expiry = []
+        self.order = itertools.count()
+    def register(self, segment, payload = None, weight = None):
+        """Add segment to self.segments and to the heap and return its 
+        handle."""
+        segment = super().register(segment, payload, weight)
+        heapq.heappush(self.expiry, (segment.right, next(self.order), segment))
+        return segment
+    def delete(self, segment):
+        """Delete segment, which has to be the handle returned by insert."""
+        super().delete(segment)
+        ## Its heap entry is skipped by expire. Drop such entries once they
+        ## outnumber the segments.
+        if len(self.expiry) > 2 * len(self.segments) + 16:
+            self.expiry = [entry for entry in self.expiry if entry[2] in self.segments]
+            heapq.heapify(self.expiry)
+    def expire(self, watermark):
+        """Delete all segments whose right endpoint is below watermark and 
+        return the list of their handles."""
+        expired = []
+        while self.expiry and self.expiry[0][0] < watermark:
+            right, order, segment = heapq.heappop(self.expiry)
+            if segment in self.segments:
+                super().delete(segment)
+                expired.append(segment)
+        return expired
+
+
+class ConcurrentSegmentTreap:
+    """A segment treap for one writer and many reader threads.
+
+    The writer changes a PersistentSegmentTreap under a lock and publishes
+    a snapshot of it when a batch of changes is complete. Readers query the
+    last published snapshot without locking. It never changes, so they see
+    either all or none of the changes of a batch.
+    """
+    def __init__(self):
+        self.writer = PersistentSegmentTreap()
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.published = self.writer.snapshot()
+    @contextmanager
+    def batch(self):
+        """Hold the writer lock and publish the changes made meanwhile when
+        the outermost batch ends."""
+        with self.lock:
+            self.depth += 1
+            try:
+                yield self
+            finally:
+                self.depth -= 1
+                if not self.depth:
+                    ## A single assignment, readers see the old or the new root.
+                    self.published = self.writer.snapshot()
+    def snapshot(self):
+        """Return the last published version, a read-only Treap. Use it for
+        several queries that have to see the same segments."""
+        return self.published
+    def stab(self, point):
+        """Return the set of all published segments that contain point."""
+        return self.published.stab(point)
+    def iter_stab(self, point):
+        """Yield all published segments that contain point, one at a time."""
+        return self.published.iter_stab(point)
+    def count(self, point):
+        """Return the number of published segments that contain point."""
+        return self.published.count(point)
+    def count_many(self, points):
+        """Return an array of the number of published segments that contain
+        each of points."""
+        return self.published.count_many(points)
+    def stab_many(self, points):
+        """Return the published segments that contain each of points in CSR
+        form, see SegmentTreap.stab_many. The ids stay on the handles of 
+        deleted segments and are not reused."""
+        return self.published.stab_many(points)
+    def query_overlap(self, interval):
+        """Return the set of all published segments that intersect interval."""
+        return self.published.query_overlap(interval)
+    def iter_overlap(self, interval):
+        """Yield all published segments that intersect interval, one at a 
+        time."""
+        return self.published.iter_overlap(interval)
+    def insert(self, segment, prio1= None, prio2= None, payload = None, weight = None):
+        """Insert segment and return its handle, see SegmentTreap.insert. 
+        Outside of a batch it is published at once."""
+        with self.batch():
+            return self.writer.insert(segment, prio1, prio2, payload, weight)
+    def insert_many(self, segments, priorities = None, payloads = None, weights = None):
+        """Insert all segments at once and return their handles, see 
+        SegmentTreap.insert_many."""
+        with self.batch():
+            return self.writer.insert_many(segments, priorities, payloads, weights)
+    def delete(self, segment):
+        """Delete segment, which has to be the handle returned by insert."""
+        with self.batch():
+            self.writer.delete(segment)
+
+
+def serve_shard(connection):
+    """Answer the requests of a ShardedSegmentTreap that arrive on 
+    connection with a SegmentTreap of one shard, until it is closed.
+
+    The pieces of the segments carry the id of their segment as payload. A
+    segment has at most one piece in a shard.
+    """
+    tree = SegmentTreap()
+    pieces = {}
+    def insert_many(segments):
+        handles = tree.insert_many([Interval(left, right) for left, right, id in segments], payloads = [id for left, right, id in segments])
+        for handle in handles:
+            pieces[handle.payload] = handle
+    def delete(ids):
+        for id in ids:
+            tree.delete(pieces.pop(id))
+    methods = {
+        "insert_many": insert_many,
+        "delete": delete,
+        "stab": lambda point: [piece.payload for piece in tree.iter_stab(point)],
+        "count": tree.count,
+        "count_many": tree.count_many,
+        "query_overlap": lambda bounds: [piece.payload for piece in tree.iter_overlap(Interval(*bounds))],
+    }
+    while True:
+        method, argument = connection.recv()
+        if method == "close":
+            break
+        try:
+            result = methods[method](argument)
+        except Exception as error:
+            result = error
+        connection.send(result)
+    connection.close()
+
+
+class ShardedSegmentTreap:
+    """A segment treap whose coordinate space is split at boundaries into
+    shards. Each shard is a SegmentTreap in a worker process, see 
+    serve_shard.
+
+    Shard i holds the points x with boundaries[i - 1] <= x < boundaries[i].
+    A segment is clipped at the boundaries it crosses and each piece is 
+    inserted into its shard. A point query asks one shard, an overlap query
+    asks all shards it intersects at the same time. The answers are merged
+    by segment id.
+    """
+    def __init__(self, boundaries):
+        """Return an empty sharded segment treap with a worker process for
+        each of the len(boundaries) + 1 shards."""
+        self.boundaries = sorted(boundaries)
+        self.segments = SegmentTable()
+        self.connections = []
+        self.workers = []
+        for i in range(len(self.boundaries) + 1):
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target = serve_shard, args = (worker_connection,), daemon = True)
+            worker.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.workers.append(worker)
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        self.close()
+    def close(self):
+        """Stop the worker processes."""
+        for connection in self.connections:
+            connection.send(("close", None))
+            connection.close()
+        for worker in self.workers:
+            worker.join()
+        self.connections = []
+        self.workers = []
+    def call(self, requests):
+        """Send each (shard, method, argument) of requests to the worker of
+        the shard and return the answers in the same order. All workers 
+        work at the same time."""
+        for shard, method, argument in requests:
+            self.connections[shard].send((method, argument))
+        results = [self.connections[shard].recv() for shard, method, argument in requests]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+    def shard_of(self, point):
+        """Return the index of the shard that contains point."""
+        return bisect.bisect_right(self.boundaries, point)
+    def clip(self, segment):
+        """Return the list of pairs of a shard and the piece of segment in 
+        it, see Interval.split_at."""
+        first = self.shard_of(segment.left)
+        last = bisect.bisect_left(self.boundaries, segment.right)
+        pieces = []
+        rest = Interval(segment.left, segment.right)
+        for shard in range(first, last):
+            piece, rest = rest.split_at(self.boundaries[shard])
+            pieces.append((shard, piece))
+        pieces.append((max(first, last), rest))
+        return pieces
+    def stab(self, point):
+        """Return the set of all segments that contain point."""
+        ids, = self.call([(self.shard_of(point), "stab", point)])
+        return {self.segments[id] for id in ids}
+    def count(self, point):
+        """Return the number of segments that contain point."""
+        count, = self.call([(self.shard_of(point), "count", point)])
+        return count
+    def count_many(self, points):
+        """Return an array of the number of segments that contain each of
+        points. Every shard counts its points at the same time. This needs
+        NumPy."""
+        import numpy as np
+        points = np.asarray(points, dtype = np.float64)
+        shards = np.searchsorted(self.boundaries, points, side = "right")
+        positions = [np.flatnonzero(shards == shard) for shard in range(len(self.connections))]
+        requests = [(shard, "count_many", points[position]) for shard, position in enumerate(positions) if len(position)]
+        counts = np.zeros(len(points), dtype = np.int64)
+        for (shard, method, argument), result in zip(requests, self.call(requests)):
+            counts[positions[shard]] = result
+        return counts
+    def query_overlap(self, interval):
+        """Return the set of all segments that intersect interval."""
+        first = self.shard_of(interval.left)
+        if interval.left == interval.right and first and self.boundaries[first - 1] == interval.left:
+            ## An empty interval on a boundary meets the segments that cross
+            ## it, but none of their pieces, which end or start there.
+            ids, = self.call([(first, "stab", interval.left)])
+            return {segment for segment in map(self.segments.__getitem__, ids) if segment.intersects(interval)}
+        last = max(first, bisect.bisect_left(self.boundaries, interval.right))
+        bounds = (interval.left, interval.right)
+        ids = set()
+        for result in self.call([(shard, "query_overlap", bounds) for shard in range(first, last + 1)]):
+            ids.update(result)
+        return {self.segments[id] for id in ids}
+    def insert(self, segment, payload = None, weight = None):
+        """Insert segment with an optional payload and weight and return its
+        handle, see SegmentTable.add."""
+        segment, = self.insert_many([segment], [payload], [weight])
+        return segment
+    def insert_many(self, segments, payloads = None, weights = None):
+        """Insert all segments at once, with optional payloads and weights,
+        and return the list of their handles. Every shard inserts its pieces
+        at the same time, see SegmentTreap.insert_many."""
+        segments = list(segments)
+        if payloads is None:
+            payloads = [None] * len(segments)
+        if weights is None:
+            weights = [None] * len(segments)
+        segments = [self.segments.add(segment, payload, weight) for segment, payload, weight in zip(segments, payloads, weights)]
+        pieces = [[] for connection in self.connections]
+        for segment in segments:
+            for shard, piece in self.clip(segment):
+                pieces[shard].append((piece.left, piece.right, segment.id))
+        self.call([(shard, "insert_many", batch) for shard, batch in enumerate(pieces) if batch])
+        return segments
+    def delete(self, segment):
+        """Delete segment, which has to be the handle returned by insert."""
+        if segment not in self.segments:
+            raise KeyError(segment)
+        self.call([(shard, "delete", [segment.id]) for shard, piece in self.clip(segment)])
+        self.segments.remove(segment)
@@ -0,0 +1,221 @@
+# Copyright (C) 2020  Johannes Wolf
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import mmap as mmap_module
+import pickle
+import struct
+from array import array
+
+from ArrayTreap import ArrayTreap, NIL
+from Segment import Segment, SegmentTable
+
+## The file starts with the header: magic, format version, number of nodes,
+## root, number of canonical subset entries, number of segment ids, number
+## of free segment ids and size of the pickled payloads. Then follow the
+## arrays in the order of ARRAYS, each of 8 byte items in native byte
+## order, and the pickled payloads.
+MAGIC = b"SEGTREAP"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("=8s7q")
+ARRAYS = (('key', 'd', 'nodes'), ('priority', 'd', 'nodes'), ('left', 'q', 'nodes'),
+    ('right', 'q', 'nodes'), ('interval_left', 'd', 'nodes'), ('interval_right', 'd', 'nodes'),
+    ('belonging', 'q', 'nodes'), ('can_offsets', 'q', 'offsets'), ('can_ids', 'q', 'can_ids'),
+    ('segment_left', 'd', 'segments'), ('segment_right', 'd', 'segments'),
+    ('segment_weight', 'd', 'segments'), ('free', 'q', 'free'))
+
+
+class LazyList:
+    """A list of size items, where item i is made by make(i) when it is 
+    first read and then kept. Items may be replaced."""
+    def __init__(self, size, make):
+        self.size = size
+        self.make = make
+        self.made = {}
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        try:
+            return self.made[i]
+        except KeyError:
+            item = self.made[i] = self.make(i)
+            return item
+
+    def __setitem__(self, i, item):
+        self.made[i] = item
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self[i]
+
+
+class MappedSegmentTable(SegmentTable):
+    """The read-only SegmentTable of a memory-mapped segment treap, see 
+    load."""
+    def __init__(self, segments, free):
+        self.segments = segments
+        self.free = free
+
+    def check_writable(self):
+        raise TypeError("a memory-mapped segment treap is read-only")
+
+    def add(self, segment, payload = None, weight = None):
+        self.check_writable()
+
+    def remove(self, segment):
+        self.check_writable()
+
+
+def node_arrays(treap):
+    """Return the root index and a dict of the per node arrays of ARRAYS for
+    a Treap or ArrayTreap, with the nodes in preorder. The canonical subsets
+    are given as the arrays can_offsets and can_ids of segment ids, as in 
+    FlatTreap."""
+    if isinstance(treap, ArrayTreap):
+        def fields(node):
+            return (treap.key[node], treap.priority[node], treap.interval_left[node], treap.interval_right[node],
+                treap.belonging_segment[node], treap.can[node], treap.left[node], treap.right[node])
+        missing, identity = NIL, int
+    else:
+        def fields(node):
+            return (node.key, node.priority, node.interval_left, node.interval_right,
+                node.belonging_segment, node._can, node.left, node.right)
+        missing, identity = None, id
+    columns = {name: array(typecode) for name, typecode, size in ARRAYS[:9]}
+    columns['can_offsets'].append(0)
+    children = []
+    stack = [treap.root]
+    while stack:
+        node = stack.pop()
+        key, priority, low, high, belonging_segment, can, left, right = fields(node)
+        columns['key'].append(key)
+        columns['priority'].append(priority)
+        columns['interval_left'].append(low)
+        columns['interval_right'].append(high)
+        columns['belonging'].append(NIL if belonging_segment is None else belonging_segment.id)
+        if can:
+            columns['can_ids'].extend(segment.id for segment in can)
+        columns['can_offsets'].append(len(columns['can_ids']))
+        children.append((identity(node), left, right))
+        if right is not missing:
+            stack.append(right)
+        if left is not missing:
+            stack.append(left)
+    index = {node: i for i, (node, left, right) in enumerate(children)}
+    for node, left, right in children:
+        columns['left'].append(NIL if left is missing else index[identity(left)])
+        columns['right'].append(NIL if right is missing else index[identity(right)])
+    return 0, columns
+
+
+def save(tree, path):
+    """Write the segment treap tree to the file path, see load."""
+    root, columns = node_arrays(tree.treap)
+    table = tree.segments.segments
+    columns['segment_left'] = array('d', (0.0 if segment is None else segment.left for segment in table))
+    columns['segment_right'] = array('d', (0.0 if segment is None else segment.right for segment in table))
+    columns['segment_weight'] = array('d', (0.0 if segment is None else segment.weight for segment in table))
+    columns['free'] = array('q', tree.segments.free)
+    payloads = [None if segment is None else segment.payload for segment in table]
+    payloads = pickle.dumps(payloads) if any(payload is not None for payload in payloads) else b""
+    with open(path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(columns['key']), root,
+            len(columns['can_ids']), len(table), len(columns['free']), len(payloads)))
+        for name, typecode, size in ARRAYS:
+            columns[name].tofile(file)
+        file.write(payloads)
+
+
+def load(path, mmap = True):
+    """Return the segment treap saved to the file path by save. It uses an 
+    ArrayTreap.
+
+    With mmap, the file is mapped into memory and the node arrays are used
+    in place, so loading takes O(1) time and processes that load the same
+    file share its pages. The canonical subsets and segment handles are 
+    only made when a query first reaches them. Such a segment treap is 
+    read-only. Without mmap, everything is copied and can be changed.
+    Weights are stored as floats.
+    """
+    from SegmentTreap import SegmentTreap
+    with open(path, "rb") as file:
+        if mmap:
+            buffer = memoryview(mmap_module.mmap(file.fileno(), 0, access = mmap_module.ACCESS_READ))
+        else:
+            buffer = memoryview(file.read())
+    magic, version, num_nodes, root, num_can_ids, num_segments, num_free, payload_size = \
+        HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError("not a segment treap file: %r" % (path,))
+    sizes = {'nodes': num_nodes, 'offsets': num_nodes + 1, 'can_ids': num_can_ids,
+        'segments': num_segments, 'free': num_free}
+    columns = {}
+    offset = HEADER.size
+    for name, typecode, size in ARRAYS:
+        end = offset + 8 * sizes[size]
+        columns[name] = buffer[offset:end].cast(typecode)
+        offset = end
+    payload_bytes = buffer[offset:offset + payload_size]
+    free = set(columns['free'])
+    payloads = LazyList(1, lambda i: pickle.loads(payload_bytes) if payload_size else None)
+
+    def make_segment(i):
+        if i in free:
+            return None
+        segment = Segment(columns['segment_left'][i], columns['segment_right'][i],
+            None if payloads[0] is None else payloads[0][i], columns['segment_weight'][i])
+        segment.id = i
+        segment.tag = hash((i, -i))
+        return segment
+
+    def make_can(node):
+        ids = columns['can_ids'][columns['can_offsets'][node]:columns['can_offsets'][node + 1]]
+        return {segments[i] for i in ids} or None
+
+    def make_belonging(node):
+        i = columns['belonging'][node]
+        return None if i == NIL else segments[i]
+
+    treap = ArrayTreap.__new__(ArrayTreap)
+    treap.root = root
+    treap.stale_keys = None
+    treap.free = []
+    if mmap:
+        segments = LazyList(num_segments, make_segment)
+        for name in ('key', 'priority', 'left', 'right', 'interval_left', 'interval_right'):
+            setattr(treap, name, columns[name])
+        treap.can = LazyList(num_nodes, make_can)
+        treap.belonging_segment = LazyList(num_nodes, make_belonging)
+        treap.fingerprints = LazyList(num_nodes, lambda node: None)
+        treap.max_covers = LazyList(num_nodes, lambda node: None)
+        treap.weights = LazyList(num_nodes, lambda node: None)
+        table = MappedSegmentTable(segments, list(columns['free']))
+    else:
+        segments = [make_segment(i) for i in range(num_segments)]
+        for name in ('key', 'priority', 'left', 'right', 'interval_left', 'interval_right'):
+            setattr(treap, name, array(columns[name].format, columns[name].tobytes()))
+        treap.can = [make_can(node) for node in range(num_nodes)]
+        treap.belonging_segment = [make_belonging(node) for node in range(num_nodes)]
+        treap.fingerprints = [None] * num_nodes
+        treap.max_covers = [None] * num_nodes
+        treap.weights = [None] * num_nodes
+        table = SegmentTable()
+        table.segments = segments
+        table.free = list(columns['free'])
+    tree = SegmentTreap(backend = "array")
+    tree.treap = treap
+    tree.segments = table
+    return tree
@@ -13,27 +13,616 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import sys
 import time
+from contextlib import contextmanager
+from itertools import zip_longest
+from math import log2
 
-from Node import Node, pNode
+from Node import Node, pNode, PersistentNode, node_fingerprint, segment_ids
 from Interval import Interval, n_inf, p_inf
 
 
+## counters of Treap.recording
+STAT_COUNTERS = ("inserts", "deletes", "spine_nodes", "max_spine", "rotations", "can_scans", "pulled_segments")
+
+
+def analyze_levels(nodes):
+    """Return the report of Treap.analyze for the triples of depth, stored
+    canonical subset (None if no set is allocated), bytes of the node and
+    whether it is a leaf of all nodes, given in an order where each node 
+    comes after its parent."""
+    levels = []
+    leaf_depths = {}
+    for depth, can, node_bytes, is_leaf in nodes:
+        if depth == len(levels):
+            levels.append({"nodes": 0, "can_entries": 0, "max_can": 0, "empty_sets": 0, "can_bytes": 0, "node_bytes": 0})
+        level = levels[depth]
+        level["nodes"] += 1
+        level["node_bytes"] += node_bytes
+        if can is not None:
+            level["can_entries"] += len(can)
+            level["max_can"] = max(level["max_can"], len(can))
+            level["empty_sets"] += not can
+            level["can_bytes"] += sys.getsizeof(can)
+        if is_leaf:
+            leaf_depths[depth] = leaf_depths.get(depth, 0) + 1
+    ## every segment has two leaves, and there is the dummy leaf
+    num_segments = (sum(leaf_depths.values()) - 1) // 2
+    references = sum(level["can_entries"] for level in levels)
+    return {
+        "nodes": sum(level["nodes"] for level in levels),
+        "segments": num_segments,
+        "height": len(levels),
+        "leaf_depths": dict(sorted(leaf_depths.items())),
+        "levels": levels,
+        "references": references,
+        "reference_bound": num_segments * log2(num_segments) if num_segments > 1 else num_segments,
+        "empty_sets": sum(level["empty_sets"] for level in levels),
+        "can_bytes": sum(level["can_bytes"] for level in levels),
+        "node_bytes": sum(level["node_bytes"] for level in levels),
+    }
+
+
+def cartesian_tree(nodes):
+    """Link nodes, which are given in symmetric order, to a treap and return
+    its root. The stack-based construction takes O(n) time.
+    """
+    ## stack holds the right spine of the treap built so far
+    stack = []
+    for node in nodes:
+        last = None
+        while stack and stack[-1].priority < node.priority:
+            last = stack.pop()
+        node.left = last
+        if stack:
+            stack[-1].right = node
+        stack.append(node)
+    return stack[0]
+
+
 class Treap:
     """A class for treaps as the base data structure for segment treaps 
-    using zipping.
+    using zipping. The canonical subsets hold Segment handles, see 
+    Segment.SegmentTable.
     """
+    node_class = Node
+
+    ## number of keys collected by invalidate_around before the stale 
+    ## fingerprints around them are marked
+    max_stale_keys = 4096
+
+    ## counters of the updates while recording, None otherwise
+    stats = None
+
+    ## FlatTreap copy for stab_many and count_many, None until it is made 
+    ## and again after every update
+    flat = None
+
     def __init__(self):
         """Return an empty Treap."""
         self.root = None
+        ## keys around which cached fingerprints, maximum covers and weights
+        ## are stale, None while none of them has been computed
+        self.stale_keys = None
 
     def __eq__(self, other):
-        return self.root == other.root
+        """Return True iff self and other have the same structure, keys,
+        priorities, associated intervals and canonical subsets. Different
+        fingerprints prove that they differ. Since a hash collision could
+        make different treaps look equal, equal ones are compared node by 
+        node, see Node.__eq__. other may also be an ArrayTreap.
+        """
+        if self.fingerprint() != other.fingerprint():
+            return False
+        if isinstance(other, Treap):
+            return self.root == other.root
+        return all(record == other_record for record, other_record in zip_longest(self.preorder(), other.preorder()))
+
+    def preorder(self):
+        """Yield the key, the priority, the associated interval, the ids of
+        the canonical subset and whether there is a left and a right child
+        of each node in preorder. Treaps with the same records are equal."""
+        stack = [] if self.root is None else [self.root]
+        while stack:
+            node = stack.pop()
+            yield (node.key, node.priority, node.interval_left, node.interval_right,
+                segment_ids(node._can), node.left is not None, node.right is not None)
+            if node.right is not None:
+                stack.append(node.right)
+            if node.left is not None:
+                stack.append(node.left)
+
+    def fingerprint(self):
+        """Return a Merkle-style hash of self, see Node.node_fingerprint.
+
+        Each node caches the fingerprint of its subtree. The operations of
+        self report where they may have changed it, see invalidate_around, 
+        so only the stale fingerprints are computed again.
+        """
+        if self.root is None:
+            return 0
+        if self.stale_keys:
+            self.mark_stale()
+        self.stale_keys = set()
+        stack = [(self.root, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if not children_done:
+                stack.append((node, True))
+                for child in (node.left, node.right):
+                    if child is not None and child._fingerprint is None:
+                        stack.append((child, False))
+                continue
+            node._fingerprint = node_fingerprint(node.key, node.priority,
+                node.interval_left, node.interval_right, node.can_fingerprint(),
+                0 if node.left is None else node.left._fingerprint,
+                0 if node.right is None else node.right._fingerprint)
+        return self.root._fingerprint
+
+    def max_overlap(self):
+        """Return the maximum number of segments that contain a common point
+        and the smallest such point.
+
+        Each node caches this pair for its subtree: the best pair of its
+        children, plus the size of its own canonical subset. Like 
+        fingerprints, only the pairs that are stale since the last call are
+        computed again, so calling this after every update is cheap.
+        """
+        if self.root is None:
+            return 0, n_inf
+        if self.stale_keys:
+            self.mark_stale()
+        self.stale_keys = set()
+        stack = [(self.root, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if not children_done:
+                stack.append((node, True))
+                for child in (node.left, node.right):
+                    if child is not None and child._max_cover is None:
+                        stack.append((child, False))
+                continue
+            if node.left is None:
+                if node.interval_left < node.interval_right:
+                    node._max_cover = (len(node.can), node.interval_left)
+                else:
+                    ## the leaf contains no point
+                    node._max_cover = (n_inf, node.interval_left)
+            else:
+                left, right = node.left._max_cover, node.right._max_cover
+                depth, point = left if left[0] >= right[0] else right
+                node._max_cover = (depth + len(node.can), point)
+        return self.root._max_cover
+
+    def update_weights(self):
+        """Bring the cached weights of all nodes up to date, see max_overlap.
+
+        Each node caches the triple of the total weight of its canonical 
+        subset, the maximum total weight of the segments in the canonical 
+        subsets of its subtree that contain a common point, and the smallest
+        such point.
+        """
+        if self.stale_keys:
+            self.mark_stale()
+        self.stale_keys = set()
+        stack = [(self.root, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if not children_done:
+                stack.append((node, True))
+                for child in (node.left, node.right):
+                    if child is not None and child._weights is None:
+                        stack.append((child, False))
+                continue
+            weight = sum(segment.weight for segment in node.can)
+            if node.left is None:
+                if node.interval_left < node.interval_right:
+                    node._weights = (weight, weight, node.interval_left)
+                else:
+                    node._weights = (weight, n_inf, node.interval_left)
+            else:
+                left, right = node.left._weights, node.right._weights
+                _, best, point = left if left[1] >= right[1] else right
+                node._weights = (weight, weight + best, point)
+
+    def weight_at(self, point):
+        """Return the total weight of the segments that contain point. It is
+        summed up from the cached weights of the canonical subsets on the 
+        search path, see update_weights."""
+        self.update_weights()
+        weight = 0
+        node = self.root
+        while node is not None:
+            weight += node._weights[0]
+            if point < node.key:
+                node = node.left
+            else:
+                node = node.right
+        return weight
+
+    def max_weight_in(self, interval):
+        """Return the maximum total weight of the segments that contain a
+        common point of interval and the smallest such point, see 
+        update_weights.
+
+        The points of interval are those of iter_overlap: left <= x < right,
+        or just left if interval is empty. Subtrees whose associated 
+        interval lies within interval are answered from their cached 
+        weights, so only the nodes around the search paths for both ends are
+        visited.
+        """
+        self.update_weights()
+        low, high = interval.left, interval.right
+        best, best_point = n_inf, None
+        stack = [(self.root, 0)]
+        while stack:
+            node, above = stack.pop()
+            if node.interval_left >= node.interval_right:
+                continue
+            if low < high:
+                if node.interval_right <= low or node.interval_left >= high:
+                    continue
+            elif not node.interval_left <= low < node.interval_right:
+                continue
+            weight, subtree, point = node._weights
+            if low < high and low <= node.interval_left and node.interval_right <= high:
+                candidate = above + subtree
+            elif node.left is None:
+                candidate, point = above + weight, max(low, node.interval_left)
+            else:
+                stack.append((node.right, above + weight))
+                stack.append((node.left, above + weight))
+                continue
+            if candidate > best or (candidate == best and point < best_point):
+                best, best_point = candidate, point
+        return best, best_point
+
+    def invalidate_around(self, key):
+        """Report that self changed around key, see mark_stale. This costs
+        nothing until the first fingerprint, maximum cover or weight has 
+        been computed. The FlatTreap copy of self is dropped.
+        """
+        self.flat = None
+        if self.stale_keys is not None:
+            self.stale_keys.add(key)
+            if len(self.stale_keys) > self.max_stale_keys:
+                self.mark_stale()
+
+    def mark_stale(self):
+        """Mark the fingerprints, maximum covers and weights of all nodes 
+        whose associated interval contains one of the stale keys (including 
+        its ends) and of their children as stale.
+
+        Inserting or deleting an endpoint key, and adding or removing a
+        segment with endpoint key, only changes such nodes. Later changes
+        keep it that way: a node whose associated interval or parent 
+        changes is reported again. The marked nodes are closed under 
+        ancestors, since associated intervals are nested.
+        """
+        for key in self.stale_keys:
+            stack = [self.root]
+            while stack:
+                node = stack.pop()
+                node._fingerprint = node._max_cover = node._weights = None
+                for child in (node.left, node.right):
+                    if child is None:
+                        continue
+                    if child.interval_left <= key <= child.interval_right:
+                        stack.append(child)
+                    else:
+                        child._fingerprint = child._max_cover = child._weights = None
+        self.stale_keys.clear()
+
+    @contextmanager
+    def recording(self):
+        """Count what the updates of self do while the context is active and
+        yield the dict of counters, see STAT_COUNTERS.
+
+        inserts and deletes count endpoints, spine_nodes and max_spine the 
+        nodes zipping walks along, rotations those of pTreap.rotate_up, 
+        can_scans the segments that are checked for canonical subsets and
+        pulled_segments those moved by Node.pull_segments_from_child.
+        When the context ends, the shape of self is added, see shape_stats.
+        Outside of it the updates only test that self.stats is None. A
+        nested context counts its own updates and adds them to the outer 
+        one when it ends.
+        """
+        outer = self.stats
+        self.stats = stats = dict.fromkeys(STAT_COUNTERS, 0)
+        try:
+            yield stats
+        finally:
+            self.stats = outer
+            if outer is not None:
+                for name in STAT_COUNTERS:
+                    outer[name] = max(outer[name], stats[name]) if name == "max_spine" else outer[name] + stats[name]
+            stats.update(self.shape_stats())
+
+    def shape_stats(self):
+        """Return a dict of the number of nodes, the depth, and the total and
+        the largest size of the canonical subsets of self."""
+        shape = {"nodes": 0, "depth": 0, "can_entries": 0, "max_can": 0}
+        stack = [] if self.is_empty() else [(self.root, 1)]
+        while stack:
+            node, depth = stack.pop()
+            size = len(node.can)
+            shape["nodes"] += 1
+            shape["depth"] = max(shape["depth"], depth)
+            shape["can_entries"] += size
+            shape["max_can"] = max(shape["max_can"], size)
+            for child in (node.left, node.right):
+                if child is not None:
+                    stack.append((child, depth + 1))
+        return shape
+
+    def analyze(self):
+        """Return a report on the shape of self and the memory of its 
+        canonical subsets as a dict, made in one pass over all nodes:
+
+        nodes, segments and height; leaf_depths maps each depth to the 
+        number of leaves there; levels lists, from the root down, the nodes,
+        canonical subset entries, largest canonical subset, allocated empty
+        sets and the bytes of the sets and of the nodes of each level. 
+        references is the total of canonical subset entries, to compare 
+        with reference_bound, n log2 n for n segments. empty_sets, 
+        can_bytes and node_bytes are the totals of all levels. Segments 
+        themselves are not counted.
+        """
+        def nodes():
+            stack = [] if self.is_empty() else [(self.root, 0)]
+            while stack:
+                node, depth = stack.pop()
+                yield depth, node._can, sys.getsizeof(node), node.left is None and node.right is None
+                for child in (node.right, node.left):
+                    if child is not None:
+                        stack.append((child, depth + 1))
+        return analyze_levels(nodes())
+
+    def count_spine(self, node, key):
+        """Count an insert that zips along the search path for key below 
+        node, see recording."""
+        length = 0
+        while node is not None:
+            length += 1
+            node = node.left if key < node.key else node.right
+        self.stats["inserts"] += 1
+        self.stats["spine_nodes"] += length
+        self.stats["max_spine"] = max(self.stats["max_spine"], length)
+
+    def new_node(self, key, priority, **options):
+        """Return a new node of self.node_class, see Node."""
+        return self.node_class(key, priority, **options)
 
     def is_empty(self):
         """Return True iff the Treap object is empty"""
         return self.root is None
 
+    def add_segment_to_cans(self, segment):
+        """Add segment to the appropriate canonical subsets of self."""
+        self.root.add_segment_to_cans(segment, self)
+        self.invalidate_around(segment.left)
+        self.invalidate_around(segment.right)
+
+    def add_segments_to_cans(self, segments):
+        """Add all segments to the appropriate canonical subsets of self."""
+        segments = list(segments)
+        self.root.add_segments_to_cans(segments)
+        for segment in segments:
+            self.invalidate_around(segment.left)
+            self.invalidate_around(segment.right)
+
+    def remove_segment_from_cans(self, segment):
+        """Remove segment from all canonical subsets of self."""
+        self.root.remove_segment_from_cans(segment)
+        self.invalidate_around(segment.left)
+        self.invalidate_around(segment.right)
+
+    def endpoint_nodes(self, endpoints):
+        """Return the inner nodes and leaves for endpoints in symmetric order.
+
+        Parameters:
+            endpoints ([(float, float, Interval)]): Triples of key, priority 
+            and belonging segment, sorted by key.
+        """
+        nodes = []
+        for key, priority, belonging_segment in endpoints:
+            nodes.append(self.new_node(key, priority, belonging_segment = belonging_segment))
+            nodes.append(self.new_node(key, n_inf, belonging_segment = belonging_segment))
+        return nodes
+
+    def set_parent(self, node, parent):
+        """Hook for treaps with parent pointers."""
+        pass
+
+    def assign_intervals(self, pending = None):
+        """Assign the associated intervals top-down from the root. If pending 
+        is given, only descend into nodes whose id is in pending; the 
+        intervals of all other subtrees are known to be right.
+        """
+        self.root.interval_left = n_inf
+        self.root.interval_right = p_inf
+        self.set_parent(self.root, None)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for child in (node.left, node.right):
+                if child is None or (pending is not None and id(child) not in pending):
+                    continue
+                if child is node.left:
+                    child.interval_left, child.interval_right = node.interval_left, node.key
+                else:
+                    child.interval_left, child.interval_right = node.key, node.interval_right
+                self.set_parent(child, node)
+                stack.append(child)
+
+    def build(self, endpoints):
+        """Replace the content of self by a treap that contains all given
+        endpoints, each once as an inner node and once as a leaf.
+
+        Parameters:
+            endpoints ([(float, float, Interval)]): Triples of key, priority 
+            and belonging segment, sorted by key.
+
+        The nodes are linked with the stack-based Cartesian tree construction
+        in a single pass. Afterwards, the associated intervals are assigned
+        top-down. Both take O(n) time. The canonical subsets stay empty.
+        """
+        nodes = [self.new_node(n_inf, n_inf)] + self.endpoint_nodes(endpoints)
+        self.root = cartesian_tree(nodes)
+        self.flat = None
+        self.assign_intervals()
+
+    def merge(self, endpoints):
+        """Insert a batch of endpoints into self in one structural pass, each
+        once as an inner node and once as a leaf.
+
+        Parameters:
+            endpoints ([(float, float, Interval)]): Triples of key, priority 
+            and belonging segment, sorted by key.
+
+        The batch is built into a treap of its own, which is then united with
+        self top-down: the root with the higher priority stays on top and the
+        other treap is split at its key, and so on for both sides. The 
+        associated intervals are assigned on the way down. Subtrees of self 
+        that no batch endpoint falls into are neither visited nor changed.
+
+        A canonical subset can only change if the associated interval of its
+        node or of its node's parent changes. The segments of changed nodes
+        are distributed again within the changed region they came from, and
+        the segments of their unchanged children move up where they cover 
+        the new parent. The segments the endpoints belong to still have to 
+        be added to the canonical subsets.
+        """
+        if not endpoints:
+            return
+        new_nodes = self.endpoint_nodes(endpoints)
+        new = {id(node) for node in new_nodes}
+        ## ids of the nodes whose associated interval changed, and new nodes
+        changed = set(new)
+        ## the nodes whose subtree may have changed, with their parents
+        visited = []
+        ## ids of the nodes whose children were visited as well
+        descended = set()
+        ## the top of each changed region with the segments taken out of it
+        displaced = {}
+        ## whether a key of the batch is already in self or in the batch
+        ## twice, which any two equal keys of the treap meet in precedes
+        ties = any(endpoints[i][0] == endpoints[i + 1][0] for i in range(len(endpoints) - 1))
+
+        def precedes(node, pivot):
+            ## node and pivot come from different treaps. New nodes go 
+            ## right of old ones with the same key, as in insert_inner_and_leaf.
+            nonlocal ties
+            if node.key == pivot.key:
+                ties = True
+            if id(node) in new:
+                return node.key < pivot.key
+            return node.key <= pivot.key
+
+        def split(node, pivot):
+            ## The nodes that precede pivot are chained by their right 
+            ## children, the others by their left children.
+            left = right = None
+            left_last = right_last = None
+            while node is not None:
+                if precedes(node, pivot):
+                    if left_last is None:
+                        left = node
+                    else:
+                        left_last.right = node
+                    left_last, node = node, node.right
+                else:
+                    if right_last is None:
+                        right = node
+                    else:
+                        right_last.left = node
+                    right_last, node = node, node.left
+            if left_last is not None:
+                left_last.right = None
+            if right_last is not None:
+                right_last.left = None
+            return left, right
+
+        ## tasks: two treaps to unite and where to hang the result, with its
+        ## associated interval and the top of the changed region above it
+        stack = [(self.root, cartesian_tree(new_nodes), None, False, n_inf, p_inf, None)]
+        while stack:
+            first, second, parent, is_left, low, high, region = stack.pop()
+            if first is None or second is None:
+                node = second if first is None else first
+                left = right = None
+            else:
+                if first.priority < second.priority:
+                    first, second = second, first
+                node = first
+                left, right = split(second, node)
+            if parent is None:
+                self.root = node
+            elif is_left:
+                parent.left = node
+            else:
+                parent.right = node
+            if node is None:
+                continue
+            visited.append((node, parent))
+            self.set_parent(node, parent)
+            if id(node) in new or node.interval_left != low or node.interval_right != high:
+                node.interval_left, node.interval_right = low, high
+                changed.add(id(node))
+                if region is None:
+                    region = node
+                    displaced[id(region)] = (region, [])
+                if node._can is not None:
+                    displaced[id(region)][1].extend(node._can)
+                    node.can = None
+            elif left is None and right is None:
+                continue
+            else:
+                region = None
+            descended.add(id(node))
+            stack.append((node.right, right, node, False, node.key, high, region))
+            stack.append((node.left, left, node, True, low, node.key, region))
+        self.flat = None
+        ## The associated interval of a changed node shrinks, so the segments
+        ## of its canonical subset have to cover the rest again, within the 
+        ## changed region they came from. Each region is entered at a node
+        ## whose parent did not change, the region's top. With equal keys, a
+        ## node can move to the other side of a new node with the same key,
+        ## so all segments are distributed again from the root, descending 
+        ## from all nodes whose children were visited.
+        pending = changed
+        if ties:
+            segments = [segment for _, region_segments in displaced.values() for segment in region_segments]
+            displaced = {id(self.root): (self.root, segments)}
+            pending = descended
+        for region, segments in displaced.values():
+            if segments:
+                region.add_segments_to_cans(set(segments), pending)
+        ## A segment in the canonical subset of an unchanged node whose parent
+        ## changed moves up while it covers the associated interval of the
+        ## parent. All other canonical subsets are right by now, except for
+        ## the segments that moved into them.
+        moved = {}
+        for node, parent in reversed(visited):
+            if node._can is None or parent is None:
+                continue
+            if id(node) not in changed and id(parent) in changed:
+                segments = node._can
+            else:
+                segments = moved.get(id(node))
+                if not segments:
+                    continue
+            low, high = parent.interval_left, parent.interval_right
+            moving = [segment for segment in segments if segment.left <= low and high <= segment.right]
+            if moving:
+                node.can = node._can.difference(moving)
+                parent.add_all_to_can(moving)
+                moved.setdefault(id(parent), []).extend(moving)
+        if self.stale_keys is not None:
+            for node, _ in visited:
+                node._fingerprint = node._max_cover = node._weights = None
+
     def find_node_to_be_replaced(self, key, priority):
         """For an insetrion using zipping: Return the node that will be 
         replaced with x_inner and its parent.
@@ -47,32 +636,60 @@ class Treap:
                 curr, parent = curr.right, curr
         return curr, parent
 
+    def segments_around_path(self, node, key):
+        """Return the union of the canonical subsets of all nodes on the 
+        search path for key starting at node and of their children.
+
+        Zipping at key only changes the associated intervals of the nodes on
+        this path and the parents of their children. Every segment whose
+        canonical subsets change is therefore in the returned set.
+        """
+        segments = set()
+        while node is not None:
+            segments |= node.can
+            if key < node.key:
+                if node.right is not None:
+                    segments |= node.right.can
+                node = node.left
+            else:
+                if node.left is not None:
+                    segments |= node.left.can
+                node = node.right
+        return segments
+
     def insert_inner_and_leaf(self, key, priority=None, belonging_segment = None):
         """Insert a segment's endpoint to self using (simple) classic zipping
         twice, once as an inner node and once as a leaf.
+
+        Nodes with the same key as x end up on the red spine, left of x, just
+        as the search for key passes them on the right.
         """
         # print("insert: ", key)
-        x = Node(key, priority, belonging_segment = belonging_segment)
-        x_leaf = Node(key, n_inf, associated_interval=Interval(key, p_inf), belonging_segment = belonging_segment)
+        x = self.new_node(key, priority, belonging_segment = belonging_segment)
+        x_leaf = self.new_node(key, n_inf, associated_interval=Interval(key, p_inf), belonging_segment = belonging_segment)
         priority = x.priority
         to_be_replaced, parent = self.find_node_to_be_replaced(key, priority)
-        segments_in_subtree = to_be_replaced.traverse()
+        segments_in_subtree = self.segments_around_path(to_be_replaced, key)
+        if self.stats is not None:
+            self.count_spine(to_be_replaced, key)
+            self.stats["can_scans"] += len(segments_in_subtree)
         # print("Segments in Subtree:", segments_in_subtree )
 
         if parent is None:
             self.root = x
         #hänge x an seinen neuen Elternknoten
-        elif x < parent:
+        elif key < parent.key:
             parent.left = x
         else:
             parent.right = x
-        x.associated_interval = to_be_replaced.associated_interval.deepcopy()
+        x.interval_left = to_be_replaced.interval_left
+        x.interval_right = to_be_replaced.interval_right
         # print("A0")
         # self.display()
         x.can = to_be_replaced.can
         to_be_replaced.can = set()
         #hänge to_be_replaced an x
-        if to_be_replaced < x:
+        if to_be_replaced.key <= key:
             x.left = to_be_replaced
         else:
             x.right = to_be_replaced
@@ -81,74 +698,91 @@ class Treap:
         fix = parent
         # self.display()
         while curr is not None:
-            if curr < x: 
+            if curr.key <= key: 
                 ## curr is red
-                while curr is not None and curr < x:
-                    curr.associated_interval.right = key
-                    curr.find_can(parent, segments_in_subtree)
+                red = True
+                while curr is not None and curr.key <= key:
+                    curr.interval_right = key
+                    curr.can = set()
                     if curr.left is not None:
-                        curr.left.find_can(curr, segments_in_subtree)
+                        curr.left.can = set()
                     curr, parent = curr.right, curr
             else: 
                 ## curr is green
-                while curr is not None and curr > x:
-                    curr.associated_interval.left = key
-                    curr.find_can(parent, segments_in_subtree)
+                red = False
+                while curr is not None and curr.key > key:
+                    curr.interval_left = key
+                    curr.can = set()
                     if curr.right is not None:
-                        curr.right.find_can(curr, segments_in_subtree)
+                        curr.right.can = set()
                     curr, parent = curr.left, curr
             if curr is not None:
-                if curr < fix:
-                    fix.left = curr 
-                else: 
+                ## fix is the end of curr's spine so far
+                if (fix is x) == red:
                     fix.right = curr
+                else: 
+                    fix.left = curr
                 fix, parent = parent, fix
         ###Find the end of the green spine.
-        if fix.key == key:
+        if fix is x:
             ## The end of the green spline is still to_be_replaced.
             fix.right = x_leaf
-            x_leaf.associated_interval.right = fix.associated_interval.right
-            x_leaf.find_can(fix, segments_in_subtree)
+            x_leaf.interval_right = fix.interval_right
         elif fix.key > key:
             ### fix is the end of the green spline
             fix.left = x_leaf
-            x_leaf.associated_interval.right = fix.key
-            x_leaf.find_can(fix, segments_in_subtree)
+            x_leaf.interval_right = fix.key
         else:
             raise
-            #par is the end of the green spline:
-            parent.left = x_leaf            
-            x_leaf.associated_interval.right = fix.key
-            x_leaf.find_can(parent, segments_in_subtree)
+        ## Put the segments of the emptied canonical subsets back. Those in
+        ## x.can still cover x and stay there.
+        for segment in segments_in_subtree:
+            if not x.is_covered_by(segment):
+                x.left.add_segment_to_spine_cans(segment, key)
+                x.right.add_segment_to_spine_cans(segment, key)
+        self.invalidate_around(key)
         # print("insert", key, "done!")
         # self.display()
 
     def complexinsert_inner_and_leaf(self, key, priority=None, belonging_segment = None):
         """Insert a segment's endpoint to self using complex zipping
         twice, once as an inner node and once as a leaf.
+
+        Complex zipping relies on the associated intervals along the spines
+        to shrink strictly, which equal keys can break. Then classic zipping
+        is used instead, which gives the same treap, see is_strict_path.
         """
         #print("insert: ", key)
-        x = Node(key, priority, belonging_segment = belonging_segment)
-        x_leaf = Node(key, n_inf, associated_interval=Interval(key, p_inf), belonging_segment = belonging_segment)
+        if not self.is_strict_path(key):
+            self.insert_inner_and_leaf(key, priority, belonging_segment)
+            return
+        x = self.new_node(key, priority, belonging_segment = belonging_segment)
+        x_leaf = self.new_node(key, n_inf, associated_interval=Interval(key, p_inf), belonging_segment = belonging_segment)
         priority = x.priority
         to_be_replaced, parent = self.find_node_to_be_replaced(key, priority)
+        if self.stats is not None:
+            self.count_spine(to_be_replaced, key)
         collection = set()
+        ## for recording
+        pulled = scanned = 0
         # print("Segments in Subtree:", segments_in_subtree )
 
         if parent is None:
             self.root = x
         #hänge x an seinen neuen Elternknoten
-        elif x < parent:
+        elif key < parent.key:
             parent.left = x
         else:
             parent.right = x
-        x.associated_interval = to_be_replaced.associated_interval.deepcopy()
+        x.interval_left = to_be_replaced.interval_left
+        x.interval_right = to_be_replaced.interval_right
         # print("A0")
         # self.display()
         x.can = to_be_replaced.can
         to_be_replaced.can = set()
         #hänge to_be_replaced an x
-        if to_be_replaced < x:
+        ## Nodes with the same key as x are red, see insert_inner_and_leaf.
+        if to_be_replaced.key <= key:
             x.left = to_be_replaced
         else:
             x.right = to_be_replaced
@@ -159,71 +793,192 @@ class Treap:
         # self.display()
         while curr is not None:
             #print("curr", curr)
-            if curr < x: 
+            if curr.key <= key: 
                 ## curr is red
-                if parent <= x:
+                if parent is x or parent.key <= key:
                     ## curr is non-corner node
-                    curr.associated_interval.right = key
+                    curr.interval_right = key
                     collection |= curr.can
-                    curr.pull_segments_from_child(curr.left, parent)
+                    pulled += curr.pull_segments_from_child(curr.left, parent)
                     curr, parent = curr.right, curr
                 else:
-                    curr.associated_interval.right = key
-                    if fix == x:
+                    curr.interval_right = key
+                    if fix is x:
                         fix.left = curr
                     else:
                         fix.right = curr
                     collection, curr.can = curr.can, collection # step 3, 4
-                    curr.can |= collection # step 1
+                    curr.add_all_to_can(collection) # step 1
+                    scanned += len(curr.can)
                     curr.update_can(fix)
-                    curr.pull_segments_from_child(curr.left, fix) # step 2
+                    pulled += curr.pull_segments_from_child(curr.left, fix) # step 2
                     fix = parent
                     curr, parent = curr.right, curr
             else: 
                 ## curr is green
-                if parent >= x:
+                if parent is x or parent.key > key:
                     ## curr is non-corner node
-                    curr.associated_interval.left = key
+                    curr.interval_left = key
                     collection |= curr.can
-                    curr.pull_segments_from_child(curr.right, parent)
+                    pulled += curr.pull_segments_from_child(curr.right, parent)
                     curr, parent = curr.left, curr
                 else:
                     #curr is corner node
-                    curr.associated_interval.left = key
-                    if fix == x:
+                    curr.interval_left = key
+                    if fix is x:
                         fix.right = curr
                     else:
                         fix.left = curr
                     collection, curr.can = curr.can, collection # step 3, 4
-                    curr.can |= collection # step 1
+                    curr.add_all_to_can(collection) # step 1
+                    scanned += len(curr.can)
                     curr.update_can(fix)
-                    curr.pull_segments_from_child(curr.right, fix) # step 2
+                    pulled += curr.pull_segments_from_child(curr.right, fix) # step 2
                     fix = parent
                     curr, parent = curr.left, curr
 
         ## We have reached the end of the tree
-        if fix == x:
+        if fix is x:
             ## The end of the green spline is still to_be_replaced.
             fix.right = x_leaf
-            x_leaf.associated_interval.right = fix.associated_interval.right
+            x_leaf.interval_right = fix.interval_right
             #x_leaf.update_can(fix, segments_in_subtree)
         elif fix.key > key:
             ### fix is the end of the green spline
             fix.left = x_leaf
-            x_leaf.associated_interval.right = fix.key
+            x_leaf.interval_right = fix.key
             #x_leaf.update_can(fix, segments_in_subtree)
         else:
             #print(curr, fix)
             raise
             #par is the end of the green spline:
             parent.left = x_leaf            
-            x_leaf.associated_interval.right = fix.key
+            x_leaf.interval_right = fix.key
             x_leaf.update_can(parent, segments_in_subtree)
         x_leaf.can = collection
         x_leaf.update_can(fix)
+        if self.stats is not None:
+            self.stats["pulled_segments"] += pulled
+            self.stats["can_scans"] += scanned + len(collection)
+        self.invalidate_around(key)
         #print("insert", key, "done!")
         self.display()
 
+    def is_strict_path(self, key):
+        """Return True iff key is not in self and no inner node on the search
+        path for key has a child with an empty associated interval, i.e. no
+        two keys on or around the path are equal.
+        """
+        node = self.root
+        while not node.is_leaf():
+            if node.key == node.interval_left or node.key == node.interval_right:
+                return False
+            if key < node.key:
+                node = node.left
+            else:
+                node = node.right
+        return node.interval_left != key
+
+    def find_inner(self, key, belonging_segment=None):
+        """Return the inner node with the given key and its parent. If
+        belonging_segment is given, the inner node must belong to it.
+        Return None, None if there is no such node.
+
+        Inner nodes with equal keys can be on both sides of each other, so
+        all nodes whose associated interval contains key are searched.
+        """
+        stack = [(self.root, None)]
+        while stack:
+            curr, parent = stack.pop()
+            if curr is None or curr.is_leaf():
+                continue
+            if curr.key == key and (belonging_segment is None or curr.belonging_segment is belonging_segment):
+                return curr, parent
+            if key <= curr.key:
+                stack.append((curr.left, curr))
+            if key >= curr.key:
+                stack.append((curr.right, curr))
+        return None, None
+
+    def delete_inner_and_leaf(self, key, belonging_segment=None):
+        """Delete a segment's endpoint from self, i.e. its inner node and its
+        leaf, by zipping the two subtrees of the inner node back together.
+        This reverses insert_inner_and_leaf and complexinsert_inner_and_leaf.
+
+        The segment itself has to be removed from the canonical subsets
+        before, see Node.remove_segment_from_cans.
+        """
+        x, parent = self.find_inner(key, belonging_segment)
+        if x is None:
+            raise KeyError(key)
+        ## red spine: right spine of x.left, ending at the leaf left of key
+        red = []
+        curr = x.left
+        while curr is not None:
+            red.append(curr)
+            curr = curr.right
+        ## green spine: left spine of x.right, ending at x's leaf
+        green = []
+        curr = x.right
+        while curr is not None:
+            green.append(curr)
+            curr = curr.left
+        x_leaf = green.pop()
+        segments_in_question = set(x.can)
+        segments_in_question |= x_leaf.can
+        for node in red:
+            segments_in_question |= node.can
+            if node.left is not None:
+                segments_in_question |= node.left.can
+        for node in green:
+            segments_in_question |= node.can
+            segments_in_question |= node.right.can
+        ## Zip both spines together. The leaf left of key has priority -inf
+        ## and therefore ends up at the bottom.
+        spine = []
+        i = j = 0
+        while i < len(red):
+            if j < len(green) and green[j].priority > red[i].priority:
+                spine.append(green[j])
+                j += 1
+            else:
+                spine.append(red[i])
+                i += 1
+        top = spine[0]
+        if parent is None:
+            self.root = top
+        elif parent.left is x:
+            parent.left = top
+        else:
+            parent.right = top
+        ## Nodes with the same key as x can be on either spine.
+        is_red = {id(node) for node in red}
+        for upper, lower in zip(spine, spine[1:]):
+            if id(upper) in is_red:
+                upper.right = lower
+            else:
+                upper.left = lower
+        leaf = spine[-1]
+        leaf.interval_right = x_leaf.interval_right
+        for node in reversed(spine[:-1]):
+            if id(node) in is_red:
+                node.interval_right = node.right.interval_right
+            else:
+                node.interval_left = node.left.interval_left
+        ## top has x's associated interval and parent, hence x's canonical subset
+        top.can = x.can
+        for upper, lower in zip(spine, spine[1:]):
+            lower.find_can(upper, segments_in_question)
+        for node in spine[:-1]:
+            if id(node) in is_red:
+                node.left.find_can(node, segments_in_question)
+            else:
+                node.right.find_can(node, segments_in_question)
+        if self.stats is not None:
+            self.stats["deletes"] += 1
+            self.stats["can_scans"] += 2 * (len(spine) - 1) * len(segments_in_question)
+        self.invalidate_around(key)
+
     def find_leaf(self, key):
         """Return the leaf whose associated interval contains key."""
         parent = None
@@ -238,6 +993,112 @@ class Treap:
             else:
                 node, parent = node.right, node
 
+    def stab(self, point):
+        """Return the set of all segments that contain point."""
+        return set(self.iter_stab(point))
+
+    def iter_stab(self, point):
+        """Yield all segments that contain point, one at a time.
+
+        The segments are taken from the canonical subsets of the nodes on
+        the search path to the leaf whose associated interval contains
+        point, as in find_leaf. Every segment is yielded exactly once.
+        """
+        node = self.root
+        while node is not None:
+            yield from node.can
+            if point < node.key:
+                node = node.left
+            else:
+                node = node.right
+
+    def count(self, point):
+        """Return the number of segments that contain point, without
+        collecting them. See iter_stab."""
+        count = 0
+        node = self.root
+        while node is not None:
+            count += len(node.can)
+            if point < node.key:
+                node = node.left
+            else:
+                node = node.right
+        return count
+
+    def stab_many(self, points):
+        """Return the ids of the segments that contain each of points in
+        CSR form, see FlatTreap.stab_many. This needs NumPy.
+        """
+        return self.flattened().stab_many(points)
+
+    def count_many(self, points):
+        """Return an array of the number of segments that contain each of
+        points, see FlatTreap.count_many. This needs NumPy.
+        """
+        return self.flattened().count_many(points)
+
+    def flattened(self):
+        """Return the FlatTreap copy of self, see flatten. It is kept until
+        the next update, so only the first batch of queries after an update
+        pays for copying all nodes."""
+        if self.flat is None:
+            self.flat = self.flatten()
+        return self.flat
+
+    def flatten(self):
+        """Return a FlatTreap copy of self with nodes in preorder."""
+        from FlatTreap import FlatTreap, NIL
+        nodes = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            if node.right is not None:
+                stack.append(node.right)
+            if node.left is not None:
+                stack.append(node.left)
+        index = {id(node): i for i, node in enumerate(nodes)}
+        return FlatTreap(0, [node.key for node in nodes],
+            [NIL if node.left is None else index[id(node.left)] for node in nodes],
+            [NIL if node.right is None else index[id(node.right)] for node in nodes],
+            [node.can for node in nodes])
+
+    def query_overlap(self, interval):
+        """Return the set of all segments that intersect interval."""
+        return set(self.iter_overlap(interval))
+
+    def iter_overlap(self, interval):
+        """Yield all segments that intersect interval, one at a time.
+
+        Only subtrees whose associated interval intersects interval are
+        visited. A segment may lie in several canonical subsets, so it is
+        only reported by the node whose associated interval contains the
+        leftmost point the segment shares with interval. That way every
+        segment is yielded exactly once without remembering what has
+        already been reported.
+
+        Like stab, it never yields an empty segment, even where
+        Interval.intersects is True for it: an empty segment contains no
+        point and lies in no canonical subset. all_intersections leaves
+        empty segments out as well.
+        """
+        if self.is_empty():
+            return
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for segment in node.can:
+                first = max(segment.left, interval.left)
+                if node.interval_left <= first < node.interval_right and segment.intersects(interval):
+                    yield segment
+            for child in (node.right, node.left):
+                if child is None:
+                    continue
+                ## The second test keeps empty query intervals working.
+                if child.intersects(interval) or \
+                child.interval_left <= interval.left < child.interval_right:
+                    stack.append(child)
+
     def display(self):
         return
         lines, _, _, _ = self.root._display_aux() 
@@ -250,16 +1111,21 @@ class pTreap(Treap):
     """A class for treaps as the base data structure for segment treaps
     using rotations.
     """
+    node_class = pNode
+
     def __init__(self):
         super().__init__()
 
-    def insert_inner_and_leaf(self, key, priority = None):
+    def set_parent(self, node, parent):
+        node.parent = parent
+
+    def insert_inner_and_leaf(self, key, priority = None, belonging_segment = None):
         """Insert a segment's endpoint to self using rotations
         twice, once as an inner node and once as a leaf.
         """
         leaf_old, parent = self.find_leaf(key)
-        inner_new = pNode(key, priority)
-        leaf_new = pNode(key, n_inf)
+        inner_new = pNode(key, priority, belonging_segment = belonging_segment)
+        leaf_new = pNode(key, n_inf, belonging_segment = belonging_segment)
         if parent is not None:
             if inner_new < parent:
                 parent.left = inner_new
@@ -277,8 +1143,45 @@ class pTreap(Treap):
         inner_new.can = leaf_old.can
         leaf_old.can = set()
         leaf_new.can = set()
-        while self.root != inner_new and inner_new.priority > inner_new.parent.priority:
+        while self.root is not inner_new and inner_new.priority > inner_new.parent.priority:
             self.rotate_up(inner_new)
+        if self.stats is not None:
+            self.stats["inserts"] += 1
+        self.invalidate_around(key)
+
+    def delete_inner_and_leaf(self, key, belonging_segment = None):
+        """Delete a segment's endpoint from self using rotations, i.e. its 
+        inner node and its leaf. This reverses insert_inner_and_leaf.
+
+        The inner node is rotated down until both its children are leaves.
+        Then it is replaced by its left leaf, which takes over its associated
+        interval and canonical subset.
+
+        The segment itself has to be removed from the canonical subsets
+        before, see Node.remove_segment_from_cans.
+        """
+        node, parent = self.find_inner(key, belonging_segment)
+        if node is None:
+            raise KeyError(key)
+        while not (node.left.is_leaf() and node.right.is_leaf()):
+            if node.left.priority > node.right.priority:
+                self.rotate_up(node.left)
+            else:
+                self.rotate_up(node.right)
+        leaf_old = node.left
+        parent = node.parent
+        if parent is None:
+            self.root = leaf_old
+        elif parent.left is node:
+            parent.left = leaf_old
+        else:
+            parent.right = leaf_old
+        leaf_old.parent = parent
+        leaf_old.associated_interval = node.associated_interval
+        leaf_old.can = node.can
+        if self.stats is not None:
+            self.stats["deletes"] += 1
+        self.invalidate_around(key)
 
     def rotate_up(self, node):
         """Rotate the inserted node up like this:
@@ -295,7 +1198,9 @@ class pTreap(Treap):
         parent = node.parent
         if parent is None:
             raise 
-        rotate_right = parent.left == node
+        if self.stats is not None:
+            self.stats["rotations"] += 1
+        rotate_right = parent.left is node
         if rotate_right:
             #print("rotate right")
             #rotate right
@@ -311,7 +1216,7 @@ class pTreap(Treap):
         grandparent = parent.parent
         node.parent, parent.parent = grandparent, node
         if grandparent:
-            if grandparent.left == parent:
+            if grandparent.left is parent:
                 grandparent.left = node
             else:
                 grandparent.right = node
@@ -326,27 +1231,155 @@ class pTreap(Treap):
         # A   Y   ->   X   C      
         #    / \      / \     
         #   B   C    A   B  
+        # (mirrored for a left rotation)
         X = parent
         Y = node
         if rotate_right:
-            A = Y.left
-            B = X.left
-            C = X.right
-            A.can |= Y.can
-            B.can |= Y.can
-            Y.can = X.can
-            X.can = B.can & C.can 
-            C.can -= X.can
-            B.can -= X.can
+            A, B, C = Y.left, X.left, X.right
+        else:
+            A, B, C = Y.right, X.right, X.left
+        ## Nodes with an empty associated interval keep an empty canonical
+        ## subset, see Node.add_to_can.
+        A.add_all_to_can(Y.can)
+        B.add_all_to_can(Y.can)
+        Y.can = X.can
+        if B.interval_left == B.interval_right:
+            X.can = C.can
+            C.can = set()
+        elif C.interval_left == C.interval_right:
+            X.can = B.can
+            B.can = set()
         else:
-            A = X.left
-            B = X.right
-            C = Y.right
-            C.can |= Y.can
-            B.can |= Y.can            
-            Y.can = X.can
-            X.can = B.can & A.can
-            A.can -= X.can
-            B.can -= X.can
+            X.can = B.can & C.can 
+            for segment in X.can:
+                C.discard_from_can(segment)
+                B.discard_from_can(segment)
+
+
+
+
+class PersistentTreap(Treap):
+    """A class for persistent treaps as the base data structure for segment
+    treaps using zipping.
+
+    snapshot() freezes the current version in O(1). Afterwards, every 
+    operation copies the nodes it is about to change (see own_around) 
+    instead of changing them in place, so the frozen versions share all 
+    other nodes and their canonical subsets with self.
+    """
+    node_class = PersistentNode
+
+    def __init__(self):
+        super().__init__()
+        ## Versions are counted per treap, nodes are never shared between
+        ## treaps.
+        self.version = 0
+        ## A snapshot may fill the caches of nodes that self copies later,
+        ## so changes are always reported, see invalidate_around.
+        self.stale_keys = set()
+
+    def new_node(self, key, priority, **options):
+        """Return a new node of the current version."""
+        node = super().new_node(key, priority, **options)
+        node.version = self.version
+        return node
+
+    def snapshot(self):
+        """Return a Treap that shows the current version of self and never
+        changes. Its queries that only read, like stab, count and 
+        query_overlap, need no lock even while self is changed."""
+        ## The frozen nodes must not hold stale fingerprints, maximum covers
+        ## or weights, since they are never marked later.
+        if self.stale_keys:
+            self.mark_stale()
+        frozen = Treap()
+        frozen.root = self.root
+        ## Nodes of the frozen version must not be changed any more.
+        self.version += 1
+        return frozen
+
+    def mark_stale(self):
+        """Mark the cached values around the stale keys as stale, see 
+        Treap.mark_stale. Nodes of older versions are skipped: neither they
+        nor their subtrees changed since they were frozen, and snapshots may
+        be reading them."""
+        for key in self.stale_keys:
+            stack = [self.root] if self.root.version == self.version else []
+            while stack:
+                node = stack.pop()
+                node._fingerprint = node._max_cover = node._weights = None
+                for child in (node.left, node.right):
+                    if child is None or child.version != self.version:
+                        continue
+                    if child.interval_left <= key <= child.interval_right:
+                        stack.append(child)
+                    else:
+                        child._fingerprint = child._max_cover = child._weights = None
+        self.stale_keys.clear()
+
+    def own(self, node):
+        """Return node if it belongs to the current version only, otherwise
+        a copy of it that does."""
+        if node.version == self.version:
+            return node
+        return node.copy(self.version)
+
+    def own_around(self, key):
+        """Make sure that all nodes whose associated interval contains key 
+        (including its ends), and their children, belong to the current
+        version only. Shared nodes are copied, and so are their ancestors.
+
+        These are the nodes that an operation at key can change, see 
+        mark_stale.
+        """
+        self.root = self.own(self.root)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.left is not None:
+                node.left = child = self.own(node.left)
+                if child.interval_left <= key <= child.interval_right:
+                    stack.append(child)
+            if node.right is not None:
+                node.right = child = self.own(node.right)
+                if child.interval_left <= key <= child.interval_right:
+                    stack.append(child)
+
+    def insert_inner_and_leaf(self, key, priority = None, belonging_segment = None):
+        """Insert a segment's endpoint to self using classic zipping, see
+        Treap.insert_inner_and_leaf."""
+        self.own_around(key)
+        super().insert_inner_and_leaf(key, priority, belonging_segment)
+
+    def delete_inner_and_leaf(self, key, belonging_segment = None):
+        """Delete a segment's endpoint from self, see 
+        Treap.delete_inner_and_leaf."""
+        self.own_around(key)
+        super().delete_inner_and_leaf(key, belonging_segment)
+
+    def merge(self, endpoints):
+        """Insert a batch of endpoints into self, see Treap.merge."""
+        for key, _, _ in endpoints:
+            self.own_around(key)
+        super().merge(endpoints)
+
+    def add_segment_to_cans(self, segment):
+        """Add segment to the appropriate canonical subsets of self. They 
+        are the children of nodes around its endpoints."""
+        self.own_around(segment.left)
+        self.own_around(segment.right)
+        super().add_segment_to_cans(segment)
 
+    def add_segments_to_cans(self, segments):
+        """Add all segments to the appropriate canonical subsets of self."""
+        segments = list(segments)
+        for segment in segments:
+            self.own_around(segment.left)
+            self.own_around(segment.right)
+        super().add_segments_to_cans(segments)
 
+    def remove_segment_from_cans(self, segment):
+        """Remove segment from all canonical subsets of self."""
+        self.own_around(segment.left)
+        self.own_around(segment.right)
+        super().remove_segment_from_cans(segment)
@@ -0,0 +1,26 @@
+# Copyright (C) 2020  Johannes Wolf
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmarks of the segment treap variants on generated workloads.
+
+Run them from the repository root with
+
+    python -m benchmarks --variant Zipping --workload uniform --operation insert --size 10000
+
+see benchmarks.__main__ for all options.
+"""
+
+from benchmarks.workloads import WORKLOADS, make_segments, make_points, make_intervals
+from benchmarks.runner import VARIANTS, OPERATIONS, run, percentile, peak_traced
@@ -0,0 +1,57 @@
+# Copyright (C) 2020  Johannes Wolf
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import platform
+
+from benchmarks.workloads import WORKLOADS
+from benchmarks.runner import VARIANTS, OPERATIONS, run
+
+
+def main(arguments = None):
+    """Run the benchmarks chosen on the command line, print a line for 
+    each and optionally write all results as JSON."""
+    parser = argparse.ArgumentParser(prog = "python -m benchmarks", description = "Time operations of segment treap variants on generated workloads.")
+    parser.add_argument("--variant", nargs = "+", choices = sorted(VARIANTS), default = ["Zipping"])
+    parser.add_argument("--workload", nargs = "+", choices = sorted(WORKLOADS), default = ["uniform"])
+    parser.add_argument("--operation", nargs = "+", choices = sorted(OPERATIONS), default = ["insert"])
+    parser.add_argument("--size", nargs = "+", type = int, default = [10000], help = "number of segments")
+    parser.add_argument("--repeat", type = int, default = 5, help = "number of measured runs")
+    parser.add_argument("--warmup", type = int, default = 1, help = "number of runs before measuring")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--json", metavar = "PATH", help = "write the results to PATH")
+    arguments = parser.parse_args(arguments)
+    results = []
+    for variant in arguments.variant:
+        for workload in arguments.workload:
+            for operation in arguments.operation:
+                for size in arguments.size:
+                    result = run(variant, workload, operation, size, arguments.repeat, arguments.warmup, arguments.seed)
+                    results.append(result)
+                    if "p50_seconds" in result:
+                        timing = "p50 %10.2f us   p99 %10.2f us" % (1e6 * result["p50_seconds"], 1e6 * result["p99_seconds"])
+                    else:
+                        timing = "best %9.2f ms   mean %9.2f ms" % (1e3 * result["best_total_seconds"], 1e3 * result["mean_total_seconds"])
+                    print("%-14s %-9s %-11s %8d   %s   peak traced %.1f MB" % (
+                        variant, workload, operation, size, timing, result["peak_traced_bytes"] / 2**20))
+    if arguments.json:
+        with open(arguments.json, "w") as file:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results}, file, indent = 2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
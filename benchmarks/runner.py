@@ -0,0 +1,205 @@
+# Copyright (C) 2020  Johannes Wolf
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import tracemalloc
+
+from SegmentTreap import pSegmentTreap, SegmentTreap, cSegmentTreap
+from benchmarks.workloads import make_segments, make_points, make_intervals
+
+## variant name -> segment treap class and constructor arguments, named as in main.test
+VARIANTS = {
+    "Rotations": (pSegmentTreap, {}),
+    "Zipping": (SegmentTreap, {}),
+    "ComplexZipping": (cSegmentTreap, {}),
+    "Array": (SegmentTreap, {"backend": "array"}),
+}
+
+
+def empty(variant):
+    """Return an empty segment treap of the variant."""
+    cls, options = VARIANTS[variant]
+    return cls(**options)
+
+
+def filled(variant, segments):
+    """Return a segment treap of the variant with segments inserted one by
+    one and the list of their handles."""
+    tree = empty(variant)
+    return tree, [tree.insert(segment) for segment in segments]
+
+
+def time_insert(variant, segments, seed):
+    """Return the seconds of each insert into an initially empty tree."""
+    tree = empty(variant)
+    samples = []
+    for segment in segments:
+        start = time.perf_counter()
+        tree.insert(segment)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def time_delete(variant, segments, seed):
+    """Return the seconds of each delete until the tree is empty again."""
+    tree, handles = filled(variant, segments)
+    samples = []
+    for handle in handles:
+        start = time.perf_counter()
+        tree.delete(handle)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def time_stab(variant, segments, seed):
+    """Return the seconds of as many stabbing queries as there are segments."""
+    tree, handles = filled(variant, segments)
+    samples = []
+    for point in make_points(len(segments), seed):
+        start = time.perf_counter()
+        tree.stab(point)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def time_overlap(variant, segments, seed):
+    """Return the seconds of as many overlap queries as there are segments."""
+    tree, handles = filled(variant, segments)
+    samples = []
+    for interval in make_intervals(len(segments), seed):
+        start = time.perf_counter()
+        tree.query_overlap(interval)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def time_bulk(variant, segments, seed):
+    """Return the seconds of building a tree of all segments at once with
+    from_segments."""
+    cls, options = VARIANTS[variant]
+    start = time.perf_counter()
+    cls.from_segments(segments, **options)
+    return [time.perf_counter() - start]
+
+
+def time_root_insert(variant, segments, seed):
+    """Return the seconds of each insert of the last hundredth of segments
+    with a priority above all others into a tree of the others built with
+    from_segments. Both endpoints go next to the root, so the insert
+    rebuilds the canonical subsets along the whole search path. Each
+    segment is deleted again, untimed, before the next one."""
+    cls, options = VARIANTS[variant]
+    cut = len(segments) - max(1, len(segments) // 100)
+    tree = cls.from_segments(segments[:cut], **options)
+    samples = []
+    for segment in segments[cut:]:
+        start = time.perf_counter()
+        handle = tree.insert(segment, 2.0, 2.0)
+        samples.append(time.perf_counter() - start)
+        tree.delete(handle)
+    return samples
+
+
+def split_batch(segments):
+    """Return the first nine tenths of segments and the rest, the batch."""
+    cut = len(segments) - len(segments) // 10
+    return segments[:cut], segments[cut:]
+
+
+def time_batch(variant, segments, seed):
+    """Return the seconds of inserting the last tenth of segments with one
+    insert_many into a tree of the others built with from_segments."""
+    cls, options = VARIANTS[variant]
+    segments, batch = split_batch(segments)
+    tree = cls.from_segments(segments, **options)
+    start = time.perf_counter()
+    tree.insert_many(batch)
+    return [time.perf_counter() - start]
+
+
+def time_batch_loop(variant, segments, seed):
+    """Return the seconds of inserting the same batch as time_batch one by
+    one with insert."""
+    cls, options = VARIANTS[variant]
+    segments, batch = split_batch(segments)
+    tree = cls.from_segments(segments, **options)
+    start = time.perf_counter()
+    for segment in batch:
+        tree.insert(segment)
+    return [time.perf_counter() - start]
+
+
+## operation name -> function(variant, segments, seed) that returns the seconds per operation
+OPERATIONS = {"insert": time_insert, "delete": time_delete, "stab": time_stab,
+    "overlap": time_overlap, "bulk": time_bulk, "batch": time_batch,
+    "batch_loop": time_batch_loop, "root_insert": time_root_insert}
+
+
+def percentile(samples, fraction):
+    """Return the nearest-rank percentile of the sorted samples."""
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def peak_traced(operation, variant, segments, seed):
+    """Run an operation once more under tracemalloc and return the peak of
+    the memory Python allocated for it in bytes, including the tree. 
+    Unlike the peak resident set size of the process, it only belongs to
+    this run."""
+    tracemalloc.start()
+    try:
+        OPERATIONS[operation](variant, segments, seed)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(variant, workload, operation, size, repeat = 5, warmup = 1, seed = 0):
+    """Run an operation on a workload of size segments with a variant 
+    warmup + repeat times and return the statistics of the last repeat 
+    runs as a dict.
+
+    Each run gets new segments and queries from its own seed. Only the 
+    operations themselves are timed, not making the segments or filling
+    the tree for queries and deletes. An operation that is timed once per
+    run, like bulk, only reports the totals of the runs. The memory peak 
+    is measured in an extra untimed run, see peak_traced.
+    """
+    samples = []
+    totals = []
+    for run_index in range(warmup + repeat):
+        segments = make_segments(workload, size, seed + run_index)
+        run_samples = OPERATIONS[operation](variant, segments, seed + run_index)
+        if run_index >= warmup:
+            samples.extend(run_samples)
+            totals.append(sum(run_samples))
+    samples.sort()
+    result = {
+        "variant": variant,
+        "workload": workload,
+        "operation": operation,
+        "size": size,
+        "repeat": repeat,
+        "warmup": warmup,
+        "seed": seed,
+        "operations": len(samples),
+        "best_total_seconds": min(totals),
+        "mean_total_seconds": sum(totals) / len(totals),
+        "peak_traced_bytes": peak_traced(operation, variant, segments, seed + run_index),
+    }
+    if len(samples) > len(totals):
+        result["p50_seconds"] = percentile(samples, 0.5)
+        result["p99_seconds"] = percentile(samples, 0.99)
+        result["mean_seconds"] = sum(samples) / len(samples)
+    return result
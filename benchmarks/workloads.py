@@ -0,0 +1,79 @@
+# Copyright (C) 2020  Johannes Wolf
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import random
+
+from Interval import Interval
+
+
+def uniform(num_segments, rng):
+    """Return segments whose endpoints are uniformly distributed in [0, 1]."""
+    segments = []
+    for i in range(num_segments):
+        first, second = rng.random(), rng.random()
+        segments.append(Interval(min(first, second), max(first, second)))
+    return segments
+
+
+def clustered(num_segments, rng, num_clusters = 10, spread = 0.01):
+    """Return short segments around a few random centers in [0, 1]."""
+    centers = [rng.random() for i in range(num_clusters)]
+    segments = []
+    for i in range(num_segments):
+        center = rng.choice(centers)
+        first, second = rng.gauss(center, spread), rng.gauss(center, spread)
+        segments.append(Interval(min(first, second), max(first, second)))
+    return segments
+
+
+def nested(num_segments, rng):
+    """Return segments around 0.5 that contain each other."""
+    widths = sorted((rng.random() / 2 for i in range(num_segments)), reverse = True)
+    return [Interval(0.5 - width, 0.5 + width) for width in widths]
+
+
+def mixed(num_segments, rng, long_share = 0.1, short_length = 0.001):
+    """Return mostly short segments and a share of long ones in [0, 1]."""
+    segments = []
+    for i in range(num_segments):
+        length = rng.uniform(0.5, 1) if rng.random() < long_share else rng.uniform(0, short_length)
+        left = rng.uniform(0, 1 - length)
+        segments.append(Interval(left, left + length))
+    return segments
+
+
+## workload name -> function(num_segments, rng) that returns the segments
+WORKLOADS = {"uniform": uniform, "clustered": clustered, "nested": nested, "mixed": mixed}
+
+
+def make_segments(workload, num_segments, seed):
+    """Return num_segments segments of the named workload."""
+    return WORKLOADS[workload](num_segments, random.Random(seed))
+
+
+def make_points(num_points, seed):
+    """Return num_points uniformly distributed query points in [0, 1]."""
+    rng = random.Random(seed)
+    return [rng.random() for i in range(num_points)]
+
+
+def make_intervals(num_intervals, seed, length = 0.01):
+    """Return num_intervals query intervals of the given length in [0, 1]."""
+    rng = random.Random(seed)
+    intervals = []
+    for i in range(num_intervals):
+        left = rng.uniform(0, 1 - length)
+        intervals.append(Interval(left, left + length))
+    return intervals
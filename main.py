@@ -15,9 +15,9 @@
 
 import time
 import random
-import matplotlib.pyplot as plt
+import threading
 
-from SegmentTreap import pSegmentTreap, SegmentTreap, cSegmentTreap
+from SegmentTreap import pSegmentTreap, SegmentTreap, cSegmentTreap, PersistentSegmentTreap, ConcurrentSegmentTreap, ShardedSegmentTreap, sorted_endpoints, all_intersections
 from Interval import Interval, n_inf, p_inf
 from Treap import Treap, pTreap
 from Node import Node, pNode, generate_priority
@@ -77,6 +77,158 @@ def random_test_double(num_segments, num_iterations):
         double.display()
 
 
+def random_test_updates(num_segments, num_iterations, batch_size = 10):
+    """Mix random inserts, batch inserts and deletes on a pSegmentTreap, a
+    SegmentTreap with each backend and a cSegmentTreap with the same 
+    priorities. After every update check that the four trees have the same
+    structure and that stab and query_overlap agree with a linear scan of 
+    the segments.
+
+    Parameters:
+
+        num_segments (int): The number of updates per iteration.
+
+        num_iterations (int): The number of repetitions, each starting with empty trees.
+
+        batch_size (int): The largest number of segments of a batch insert.
+
+    Result:
+
+        Nothing, if the trees are always right. An error, if at any time, they are not.
+    """
+    for iteration in range(num_iterations):
+        trees = [pSegmentTreap(), SegmentTreap(), cSegmentTreap(), SegmentTreap(backend = "array")]
+        ## all endpoints are distinct, so equal priorities give equal trees
+        num_keys = 2 * num_segments * batch_size
+        free_keys = list(range(num_keys))
+        random.shuffle(free_keys)
+        live = []
+        for update in range(num_segments):
+            action = random.random()
+            if action < 0.3 and live:
+                handles = live.pop(random.randrange(len(live)))
+                for tree, handle in zip(trees, handles):
+                    tree.delete(handle)
+                free_keys += [handles[0].left, handles[0].right]
+            else:
+                count = random.randint(1, batch_size) if action < 0.6 else 1
+                count = min(count, len(free_keys) // 2)
+                segments = []
+                priorities = []
+                for i in range(count):
+                    first, second = sorted((free_keys.pop(), free_keys.pop()))
+                    segments.append(Interval(first, second))
+                    priorities.append((generate_priority(), generate_priority()))
+                if count == 1:
+                    inserted = [[tree.insert(segments[0], *priorities[0])] for tree in trees]
+                else:
+                    inserted = [tree.insert_many(segments, priorities) for tree in trees]
+                live += zip(*inserted)
+            if not trees[0] == trees[1] == trees[2] == trees[3]:
+                for tree in trees:
+                    tree.display()
+                raise AssertionError("the trees differ after update " + str(update))
+            for tree, handles in zip(trees, zip(*live) if live else [()] * len(trees)):
+                for point in (random.uniform(-1, num_keys), random.randrange(num_keys)):
+                    assert tree.stab(point) == {segment for segment in handles if segment.left <= point < segment.right}
+                first, second = sorted(random.randrange(num_keys) for i in range(2))
+                interval = Interval(first, second + random.random())
+                assert tree.query_overlap(interval) == {segment for segment in handles if segment.intersects(interval)}
+
+
+def random_test_overlaps(num_segments, num_iterations):
+    """Insert random segments with few distinct endpoints, many of them
+    empty, into a pSegmentTreap, a SegmentTreap with each backend and a
+    cSegmentTreap. Check that query_overlap and iter_overlap, also for empty
+    query intervals, and all_intersections agree with a linear scan that
+    leaves out empty segments.
+
+    Parameters:
+
+        num_segments (int): The number of segments per iteration.
+
+        num_iterations (int): The number of repetitions, each with new trees.
+
+    Result:
+
+        Nothing, if the queries are always right. An error, if at any time, they are not.
+    """
+    for iteration in range(num_iterations):
+        trees = [pSegmentTreap(), SegmentTreap(), cSegmentTreap(), SegmentTreap(backend = "array")]
+        num_keys = max(2, num_segments // 4)
+        segments = []
+        for i in range(num_segments):
+            first, second = sorted(random.randrange(num_keys) for j in range(2))
+            segments.append(Interval(first, second))
+        for tree in trees:
+            handles = tree.insert_many(segments)
+            for j in range(num_segments // 10 + 1):
+                first, second = sorted(random.randrange(-1, num_keys + 1) for k in range(2))
+                interval = Interval(first, second)
+                expected = {segment for segment in handles if segment.left < segment.right and segment.intersects(interval)}
+                assert tree.query_overlap(interval) == expected
+                found = list(tree.iter_overlap(interval))
+                assert len(found) == len(expected) and set(found) == expected
+        pairs = [frozenset((id(first), id(second))) for first, second in all_intersections(handles)]
+        expected = {frozenset((id(first), id(second))) for i, first in enumerate(handles) for second in handles[i + 1:]
+            if first.left < first.right and second.left < second.right and first.intersects(second)}
+        assert len(pairs) == len(expected) and set(pairs) == expected
+
+
+def random_test_snapshots(num_updates, num_iterations, num_kept = 5):
+    """Insert and delete random weighted segments in a
+    PersistentSegmentTreap, take a snapshot after some updates and check
+    the cached aggregates of the live tree and of the last snapshots
+    against a brute-force count: max_overlap, weight_at and, compared with
+    a PersistentSegmentTreap without snapshots that gets the same updates,
+    fingerprint.
+
+    Parameters:
+
+        num_updates (int): The number of updates per iteration.
+
+        num_iterations (int): The number of repetitions, each starting with empty trees.
+
+        num_kept (int): The number of snapshots that are checked after every update.
+
+    Result:
+
+        Nothing, if the aggregates are always right. An error, if at any time, they are not.
+    """
+    def check(tree, segments, fingerprint):
+        depth, point = tree.max_overlap()
+        cover = lambda point: [segment for segment in segments if segment.left <= point < segment.right]
+        assert depth == max([len(cover(segment.left)) for segment in segments] + [0])
+        assert len(segments) == 0 or len(cover(point)) == depth
+        point = random.uniform(-1, 101)
+        assert tree.weight_at(point) == sum(segment.weight for segment in cover(point))
+        assert tree.fingerprint() == fingerprint
+    for iteration in range(num_iterations):
+        tree = PersistentSegmentTreap()
+        ## the ids of deleted segments are not reused in either tree
+        twin = PersistentSegmentTreap()
+        live = []
+        snapshots = []
+        for update in range(num_updates):
+            if random.random() < 0.3 and live:
+                handle, twin_handle = live.pop(random.randrange(len(live)))
+                tree.delete(handle)
+                twin.delete(twin_handle)
+            else:
+                first, second = sorted(random.randrange(100) for i in range(2))
+                segment = Interval(first, second + random.random())
+                priorities = (generate_priority(), generate_priority())
+                weight = random.randint(1, 5)
+                live.append((tree.insert(segment, *priorities, weight = weight), twin.insert(segment, *priorities, weight = weight)))
+            segments = [handle for handle, twin_handle in live]
+            ## A new snapshot is checked before the live tree brings its 
+            ## cached values up to date.
+            if random.random() < 0.2:
+                snapshots = snapshots[1 - num_kept:] + [(tree.snapshot(), segments, twin.fingerprint())]
+            for snapshot, frozen_segments, fingerprint in reversed(snapshots):
+                check(snapshot, frozen_segments, fingerprint)
+            check(tree, segments, twin.fingerprint())
+
 
 def test(num_segments=100, num_iterations=1000, method = "Rotations"):
     """Generate random segments. Measure the time to insert them to one of three different kinds of segment treaps.
@@ -122,6 +274,155 @@ def test(num_segments=100, num_iterations=1000, method = "Rotations"):
     return end - start
 
 
+def stress_degenerate_priorities(num_nodes = 10**7):
+    """Build a segment treap whose priorities decrease with the keys, so 
+    that it degenerates to a path, and time the tree walks on it that used 
+    to be recursive.
+
+    Parameters:
+
+        num_nodes (int): The approximate number of nodes of the treap. 
+        Each segment contributes four nodes.
+
+    Returns:
+
+        A dict that maps each operation to the time it took in seconds.
+    """
+    num_segments = max(1, num_nodes // 4)
+    segments = [Interval(2 * i, 2 * i + 1) for i in range(num_segments)]
+    priorities = [(-2 * i, -2 * i - 1) for i in range(num_segments)]
+    timings = {}
+    start = time.time()
+    tree = SegmentTreap()
+    tree.treap.build(sorted_endpoints(segments, priorities))
+    twin = SegmentTreap()
+    twin.treap.build(sorted_endpoints(segments, priorities))
+    timings["build both"] = time.time() - start
+    start = time.time()
+    equal = tree == twin
+    timings["__eq__"] = time.time() - start
+    del twin
+    start = time.time()
+    num_traversed = len(tree.treap.root.traverse())
+    timings["traverse"] = time.time() - start
+    ## The long segment crosses every key, so it is pushed down the whole path.
+    long_segment = tree.segments.add(Interval(0.5, 2 * num_segments - 0.5))
+    start = time.time()
+    tree.treap.add_segment_to_cans(long_segment)
+    timings["add_segment_to_cans"] = time.time() - start
+    start = time.time()
+    tree.treap.remove_segment_from_cans(long_segment)
+    timings["remove_segment_from_cans"] = time.time() - start
+    assert equal and num_traversed == num_segments
+    print("Degenerate treap with", 4 * num_segments + 1, "nodes:")
+    for operation, seconds in timings.items():
+        print("   ", operation, round(seconds, 3), "s")
+    return timings
+
+
+def stress_concurrent_reads(num_segments = 10000, queries_per_thread = 20000, thread_counts = (1, 2, 4, 8), batch_size = 100):
+    """Count and stab the segments at random points from several reader 
+    threads of a ConcurrentSegmentTreap while a writer thread inserts and 
+    deletes segments in batches, and time the reads for each number of 
+    readers. The readers also check that the batch queries of a snapshot
+    agree with each other. This needs NumPy.
+
+    Parameters:
+
+        num_segments (int): The number of segments inserted before the 
+        readers start. The writer keeps their number, every insert is 
+        followed by the delete of a random segment.
+
+        queries_per_thread (int): The number of points each reader queries 
+        with count, and again with count_many and stab_many in batches of
+        batch_size points.
+
+        thread_counts (iterable of int): The numbers of reader threads.
+
+        batch_size (int): The number of segments the writer publishes at once.
+
+    Returns:
+
+        A dict that maps each number of readers to their total queries per second.
+    """
+    def random_segment():
+        first, second = random.random(), random.random()
+        return Interval(min(first, second), max(first, second))
+    throughput = {}
+    for num_threads in thread_counts:
+        tree = ConcurrentSegmentTreap()
+        handles = tree.insert_many([random_segment() for i in range(num_segments)])
+        stop = threading.Event()
+        errors = []
+        def write():
+            while not stop.is_set():
+                with tree.batch():
+                    for i in range(batch_size):
+                        handles.append(tree.insert(random_segment()))
+                        tree.delete(handles.pop(random.randrange(len(handles))))
+        def read():
+            try:
+                for i in range(queries_per_thread // batch_size):
+                    points = [random.random() for j in range(batch_size)]
+                    for point in points:
+                        tree.count(point)
+                    snapshot = tree.snapshot()
+                    counts = snapshot.count_many(points)
+                    offsets, ids = snapshot.stab_many(points)
+                    assert list(offsets[1:] - offsets[:-1]) == list(counts)
+            except Exception as error:
+                errors.append(error)
+        writer = threading.Thread(target = write)
+        readers = [threading.Thread(target = read) for i in range(num_threads)]
+        writer.start()
+        start = time.time()
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        seconds = time.time() - start
+        stop.set()
+        writer.join()
+        if errors:
+            raise errors[0]
+        throughput[num_threads] = 3 * num_threads * (queries_per_thread // batch_size) * batch_size / seconds
+        print(num_threads, "readers:", round(throughput[num_threads]), "queries/s")
+    return throughput
+
+
+def stress_sharded_queries(num_segments = 100000, num_points = 10**6, shard_counts = (1, 2, 4, 8)):
+    """Insert random segments into ShardedSegmentTreaps with equally wide
+    shards of [0, 1] and time a batch of count queries for each number of
+    shards.
+
+    Parameters:
+
+        num_segments (int): The number of segments.
+
+        num_points (int): The number of query points of the batch.
+
+        shard_counts (iterable of int): The numbers of shards, i.e. of worker processes.
+
+    Returns:
+
+        A dict that maps each number of shards to the queries per second.
+    """
+    segments = []
+    for i in range(num_segments):
+        first, second = random.random(), random.random()
+        segments.append(Interval(min(first, second), max(first, second)))
+    points = [random.random() for i in range(num_points)]
+    throughput = {}
+    for num_shards in shard_counts:
+        with ShardedSegmentTreap([i / num_shards for i in range(1, num_shards)]) as tree:
+            tree.insert_many(segments)
+            start = time.time()
+            tree.count_many(points)
+            throughput[num_shards] = num_points / (time.time() - start)
+        print(num_shards, "shards:", round(throughput[num_shards]), "queries/s")
+    return throughput
+
+
 def plot_results(max_num_segments = 1000, step = 50, segments_per_iteration = 100000, Rotations = True, classic_zipping = True, complex_zipping = True, filename = 'test.png'):
     """plot the results of the test() function for different kinds of segment treaps
     
@@ -153,6 +454,7 @@ def plot_results(max_num_segments = 1000, step = 50, segments_per_iteration = 10
         x-axis: number of inserted segments per iteration
         y-axis: average time of generating Segment Treap per iteration.
     """
+    import matplotlib.pyplot as plt
     start = time.time()
 
     data_rotations = []
@@ -190,7 +492,11 @@ def plot_results(max_num_segments = 1000, step = 50, segments_per_iteration = 10
     seconds = seconds % 60
     print("Making this graph took", minutes, "minutes and ", seconds, "seconds.")
 
-plot_results(1000, 10, 100000, complex_zipping=True, filename="three.png")
-plot_results(1000, 10, 100000, complex_zipping=False, filename="two.png")
-# random_test_double(100,100)
+if __name__ == "__main__":
+    plot_results(1000, 10, 100000, complex_zipping=True, filename="three.png")
+    plot_results(1000, 10, 100000, complex_zipping=False, filename="two.png")
+    # random_test_double(100,100)
+    # random_test_updates(100,100)
+    # random_test_overlaps(200,50)
+    # random_test_snapshots(200,20)
 